@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""Time and memory of gathering commit stats (count and main author) on a branch with many commits.
+
+Compares the streaming `stats.branch_stats` with building a GitPython commit object per commit and scraping
+`git log`, which is what merging used to do.
+
+Usage: python benchmarks/commit_stats.py [--commits N] [--authors N]
+"""
+
+import os
+import re
+import sys
+import time
+import shutil
+import argparse
+import subprocess
+import tempfile
+import tracemalloc
+from itertools import groupby
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'src'))
+
+
+def build_repo(path, num_commits, num_authors):
+    subprocess.run(['git', 'init', '-q', '--bare', path], check=True)
+    chunks = []
+    for i in range(num_commits):
+        author = f'Author {i % num_authors} <author{i % num_authors}@example.com> {1700000000 + i} +0000'
+        message = f'Commit {i}\n\nCo-authored-by: Pair {i % 3} <pair{i % 3}@example.com>\n'
+        chunks.append(f'commit refs/heads/{"main" if i == 0 else "branch"}\nauthor {author}\ncommitter {author}\n')
+        chunks.append(f'data {len(message)}\n{message}')
+        if i == 1:
+            chunks.append('from refs/heads/main\n')
+        chunks.append(f'M 100644 inline file_{i % 100}.txt\ndata {len(str(i)) + 1}\n{i}\n\n')
+    subprocess.run(['git', '-C', path, 'fast-import', '--quiet'], input=''.join(chunks), text=True, check=True)
+
+
+def iter_commits_stats(git_repo, base, head):
+    num_commits = len(list(git_repo.iter_commits(f'{base}..{head}')))
+    commit_log = git_repo.git.log(head, '-n', num_commits)
+    commit_authors = sorted(list(re.findall(r'Author: (.*?)\n', commit_log)))
+    commit_authors_count = {k: len(list(g)) for k, g in groupby(commit_authors)}
+    return num_commits, max(commit_authors_count, key=commit_authors_count.get)
+
+
+def streaming_stats(git_repo, base, head):
+    from git_pr_linear_merge import stats
+    commit_stats = stats.branch_stats(git_repo, base, head)
+    return commit_stats.num_commits, commit_stats.main_author
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    duration_ms = (time.perf_counter() - start) * 1000
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, duration_ms, peak / (1024 * 1024)
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Benchmark commit stats on a branch with many commits')
+    parser.add_argument('--commits', type=int, default=20000, help='number of commits on the branch')
+    parser.add_argument('--authors', type=int, default=20, help='number of distinct authors')
+    args = parser.parse_args()
+
+    import git
+    repo_path = tempfile.mkdtemp(prefix='git-pr-bench-stats-')
+    try:
+        build_repo(repo_path, args.commits + 1, args.authors)
+        git_repo = git.Repo(repo_path)
+        for name, fn in [('iter_commits', iter_commits_stats), ('streaming', streaming_stats)]:
+            (num_commits, main_author), duration_ms, peak_mb = measure(fn, git_repo, 'main', 'branch')
+            print(f'{name:14} {duration_ms:10.1f} ms {peak_mb:8.1f} MB peak   {num_commits} commits, main author {main_author}')
+    finally:
+        shutil.rmtree(repo_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    run()
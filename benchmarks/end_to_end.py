@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""End-to-end benchmark of `git pr list` and `git pr merge`, fully offline.
+
+The GitHub api is served by a local fake (fake_github.py) and `origin` is a generated bare repository. Results are
+appended to a results file together with the commit they were measured on, and compared with the last results
+measured on a different commit with the same parameters, so regressions show up.
+
+Usage: python benchmarks/end_to_end.py [--runs N] [--repo-commits N] [--repo-files N] [--pr-commits N]
+                                       [--open-prs N] [--stacked-prs N] [--api-latency-ms N] [--results FILE] [--json]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import builtins
+import platform
+import statistics
+import subprocess
+import tempfile
+import contextlib
+from datetime import datetime, timezone
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'src'))
+
+from fake_github import FakeGithub, OWNER, REPO
+
+DEFAULT_RESULTS_FILE = os.path.join(BENCHMARKS_DIR, 'results.jsonl')
+# Slowdowns beyond this are reported as regressions
+REGRESSION_THRESHOLD = 0.10
+
+
+def _git(cwd, *args, **kwargs):
+    return subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True, text=True, **kwargs).stdout.strip()
+
+
+def _fast_import_stream(repo_commits, repo_files, pr_commits, open_prs, stacked_prs):
+    # Builds the whole history in a single `git fast-import`, which is a lot faster than committing one by one
+    chunks = []
+    marks = {'next': 1}
+    timestamp = 1700000000
+
+    def commit(ref, parent_mark, message, files):
+        nonlocal timestamp
+        mark = marks['next']
+        marks['next'] += 1
+        timestamp += 60
+        chunks.append(f'commit {ref}\nmark :{mark}\n')
+        chunks.append(f'author Bench Author <bench@example.com> {timestamp} +0000\n')
+        chunks.append(f'committer Bench Author <bench@example.com> {timestamp} +0000\n')
+        message = message.encode('utf-8')
+        chunks.append(f'data {len(message)}\n{message.decode("utf-8")}\n')
+        if parent_mark:
+            chunks.append(f'from :{parent_mark}\n')
+        for path, content in files.items():
+            content = content.encode('utf-8')
+            chunks.append(f'M 100644 inline {path}\ndata {len(content)}\n{content.decode("utf-8")}\n')
+        chunks.append('\n')
+        return mark
+
+    main_tip = commit('refs/heads/main', None, 'Initial commit',
+        {f'src/file_{i}.txt': f'file {i}\n' for i in range(repo_files)})
+    for i in range(1, repo_commits):
+        main_tip = commit('refs/heads/main', main_tip, f'Main commit {i}', {f'src/file_{i % repo_files}.txt': f'file {i}\n'})
+
+    pulls = []
+    first_pr_tip = None
+    for pr in range(1, open_prs + 1):
+        tip = main_tip
+        for c in range(pr_commits):
+            tip = commit(f'refs/heads/feature/{pr}', tip, f'PR {pr} commit {c}', {f'feature_{pr}/change_{c}.txt': f'pr {pr} commit {c}\n'})
+        first_pr_tip = first_pr_tip or tip
+        pulls.append((pr, f'feature/{pr}', 'main'))
+
+    # Stacked pull requests are based on the first pull request, they are retargeted when it is merged
+    tip = first_pr_tip
+    base = 'feature/1'
+    for s in range(1, stacked_prs + 1):
+        tip = commit(f'refs/heads/stack/{s}', tip, f'Stacked PR {s}', {f'stack_{s}.txt': f'stack {s}\n'})
+        pulls.append((open_prs + s, f'stack/{s}', base))
+        base = f'stack/{s}'
+
+    # Move main on, so that merging requires a rebase
+    commit('refs/heads/main', main_tip, 'Main moved on', {'main.txt': 'main moved on\n'})
+    return ''.join(chunks), pulls
+
+
+def build_fixture(root, params):
+    origin = os.path.join(root, 'origin.git')
+    work = os.path.join(root, 'work')
+    _git(root, 'init', '-q', '--bare', '-b', 'main', origin)
+    stream, pulls = _fast_import_stream(params['repo_commits'], params['repo_files'], params['pr_commits'],
+        params['open_prs'], params['stacked_prs'])
+    _git(origin, 'fast-import', '--quiet', input=stream)
+    _git(root, 'clone', '-q', origin, work)
+    _git(work, 'config', 'user.name', 'Bench User')
+    _git(work, 'config', 'user.email', 'bench-user@example.com')
+    return origin, work, pulls
+
+
+@contextlib.contextmanager
+def fresh_copy(fixture_root, pulls, api_latency_ms):
+    # Merging changes the remote and the clone, so every run gets its own copy and its own fake api
+    run_root = tempfile.mkdtemp(prefix='git-pr-bench-run-')
+    try:
+        shutil.copytree(os.path.join(fixture_root, 'origin.git'), os.path.join(run_root, 'origin.git'), symlinks=True)
+        work = os.path.join(run_root, 'work')
+        shutil.copytree(os.path.join(fixture_root, 'work'), work, symlinks=True)
+        _git(work, 'remote', 'set-url', 'origin', os.path.join(run_root, 'origin.git'))
+        server = FakeGithub(os.path.join(run_root, 'origin.git'), api_latency_ms / 1000).start()
+        for number, head, base in pulls:
+            server.add_pull(number, head, base)
+        try:
+            yield work, server
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(run_root, ignore_errors=True)
+
+
+def _connect(server):
+    from github import Github
+    github = Github('benchmark-token', base_url=server.base_url)
+    return github, github.get_repo(f'{OWNER}/{REPO}')
+
+
+def time_list(fixture_root, pulls, api_latency_ms):
+    from git_pr_linear_merge import main
+    with fresh_copy(fixture_root, pulls, api_latency_ms) as (work, server):
+        github, github_repo = _connect(server)
+        num_requests_before = len(server.requests)
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            main.list_command(github, github_repo)
+        return (time.perf_counter() - start) * 1000, len(server.requests) - num_requests_before
+
+
+def time_merge(fixture_root, pulls, api_latency_ms, no_checkout):
+    import git
+    import configparser
+    from git_pr_linear_merge import main, cfg
+    with fresh_copy(fixture_root, pulls, api_latency_ms) as (work, server):
+        github, github_repo = _connect(server)
+        git_repo = git.Repo(work)
+        merge_config = cfg.MergeConfig(configparser.ConfigParser())
+        merge_config.no_checkout = no_checkout
+        num_requests_before = len(server.requests)
+        start = time.perf_counter()
+        main.merge_command(False, git_repo, github_repo, 1, merge_config)
+        duration_ms = (time.perf_counter() - start) * 1000
+
+        # Make sure we measured a merge and not an early exit
+        if _git(work, 'ls-remote', '--heads', 'origin', 'feature/1'):
+            raise RuntimeError('The pull request was not merged, run with -v to see why')
+        return duration_ms, len(server.requests) - num_requests_before
+
+
+def _current_commit():
+    try:
+        commit = _git(REPO_DIR, 'rev-parse', '--short', 'HEAD')
+        dirty = _git(REPO_DIR, 'status', '--porcelain', '--untracked-files=no')
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _load_results(results_file):
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _previous_result(results, params, commit):
+    for result in reversed(results):
+        if result['params'] == params and result['commit'] != commit:
+            return result
+    return None
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark of `git pr list` and `git pr merge`')
+    parser.add_argument('--runs', type=int, default=5, help='number of runs per measurement')
+    parser.add_argument('--repo-commits', type=int, default=1000, help='number of commits on the base branch')
+    parser.add_argument('--repo-files', type=int, default=1000, help='number of files in the repository')
+    parser.add_argument('--pr-commits', type=int, default=5, help='number of commits per pull request')
+    parser.add_argument('--open-prs', type=int, default=20, help='number of open pull requests')
+    parser.add_argument('--stacked-prs', type=int, default=3, help='number of pull requests stacked on the merged one, they get retargeted')
+    parser.add_argument('--api-latency-ms', type=int, default=0, help='delay of every api response, to simulate the round trip to github.com')
+    parser.add_argument('--results', default=DEFAULT_RESULTS_FILE, help='file the results are appended to')
+    parser.add_argument('--no-save', action='store_true', help="don't append the results to the results file")
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the output of the commands')
+    args = parser.parse_args()
+
+    from git_pr_linear_merge import logger, cache
+    if args.verbose:
+        logger.setup_logging(logging.INFO)
+    else:
+        logging.getLogger().setLevel(logging.CRITICAL + 1)
+    builtins.input = lambda prompt='': 'y'
+    cache.install(None)
+
+    params = {
+        'repo_commits': args.repo_commits,
+        'repo_files': args.repo_files,
+        'pr_commits': args.pr_commits,
+        'open_prs': args.open_prs,
+        'stacked_prs': args.stacked_prs,
+        'api_latency_ms': args.api_latency_ms,
+    }
+    fixture_root = tempfile.mkdtemp(prefix='git-pr-bench-')
+    try:
+        _, _, pulls = build_fixture(fixture_root, params)
+        measurements = {
+            'list': [time_list(fixture_root, pulls, args.api_latency_ms) for _ in range(args.runs)],
+            'merge': [time_merge(fixture_root, pulls, args.api_latency_ms, False) for _ in range(args.runs)],
+            'merge_no_checkout': [time_merge(fixture_root, pulls, args.api_latency_ms, True) for _ in range(args.runs)],
+        }
+    finally:
+        shutil.rmtree(fixture_root, ignore_errors=True)
+
+    metrics = {}
+    for name, runs in measurements.items():
+        metrics[f'{name}_ms'] = statistics.median(duration for duration, _ in runs)
+        metrics[f'{name}_api_requests'] = runs[0][1]
+
+    commit = _current_commit()
+    result = {
+        'commit': commit,
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'git': _git(REPO_DIR, 'version'),
+        'runs': args.runs,
+        'params': params,
+        'metrics': metrics,
+    }
+    previous = _previous_result(_load_results(args.results), params, commit)
+    if not args.no_save:
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print(f'Commit {commit}, ' + ', '.join(f'{k}={v}' for k, v in params.items()))
+    if previous:
+        print(f'Compared with {previous["commit"]} ({previous["date"]})')
+    for name, value in metrics.items():
+        line = f'{name:32} {value:10.1f}' if isinstance(value, float) else f'{name:32} {value:10}'
+        if previous and name in previous['metrics'] and name.endswith('_ms') and previous['metrics'][name]:
+            change = value / previous['metrics'][name] - 1
+            line += f'  {change:+.0%}' + ('  REGRESSION' if change > REGRESSION_THRESHOLD else '')
+        print(line)
+
+
+if __name__ == '__main__':
+    run()
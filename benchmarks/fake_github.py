@@ -0,0 +1,253 @@
+"""Local stand-in for the GitHub REST (and GraphQL) endpoints used by `git pr`, backed by a bare repository.
+
+Used by the end-to-end benchmarks, point `Github(base_url=server.base_url)` at it.
+"""
+
+import os
+import hashlib
+import json
+import re
+import subprocess
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+OWNER = 'acme'
+REPO = 'widgets'
+USER = {'login': 'octo', 'id': 1, 'name': 'Octo Cat', 'type': 'User'}
+
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME='GitHub', GIT_AUTHOR_EMAIL='noreply@github.com',
+               GIT_COMMITTER_NAME='GitHub', GIT_COMMITTER_EMAIL='noreply@github.com')
+
+
+def git(bare, *args):
+    return subprocess.run(['git', '-C', bare, *args], check=True, capture_output=True, text=True, env=GIT_ENV).stdout.strip()
+
+
+class FakeGithub:
+    """Serves the repo, pulls, pull merge, pull edit, commit pulls and user endpoints on a random local port
+
+    Pull requests have labels and a combined CI status, set them directly in `pulls` for the GraphQL readiness query.
+    """
+
+    def __init__(self, bare_repo_path, latency=0):
+        self.bare = bare_repo_path
+        # Seconds every response is delayed by, to simulate the round trip to github.com
+        self.latency = latency
+        self.pulls = {}
+        self.requests = []
+        self.not_modified = 0
+        # Every change to a pull request moves its updated_at one minute on
+        self.clock = 1704067200
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def add_pull(self, number, head, base, title=None, user=USER, head_repo=f'{OWNER}/{REPO}'):
+        self.pulls[number] = {'number': number, 'head': head, 'head_repo': head_repo, 'base': base, 'title': title or f'PR {number}',
+                              'state': 'open', 'merged': False, 'user': user, 'last_head_sha': None,
+                              'updated_at': self._tick(), 'labels': [], 'ci_status': 'SUCCESS'}
+        self._sync_pull_ref(self.pulls[number])
+
+    def _tick(self):
+        self.clock += 60
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.clock))
+
+    def _sync_pull_ref(self, p):
+        # GitHub keeps refs/pull/N/head pointing at the pull request head
+        head_sha = self._sha(p['head'])
+        if head_sha:
+            git(self.bare, 'update-ref', f'refs/pull/{p["number"]}/head', head_sha)
+
+    def _sha(self, ref):
+        try:
+            return git(self.bare, 'rev-parse', '--verify', '-q', f'refs/heads/{ref}')
+        except subprocess.CalledProcessError:
+            return None
+
+    def _pull_json(self, p):
+        self._sync_pull_ref(p)
+        head_sha = self._sha(p['head']) or p['last_head_sha']
+        p['last_head_sha'] = head_sha
+        base_sha = self._sha(p['base'])
+        if not p['merged'] and head_sha and base_sha and p['state'] == 'open':
+            r = subprocess.run(['git', '-C', self.bare, 'merge-base', '--is-ancestor', head_sha, base_sha])
+            if r.returncode == 0 and head_sha != base_sha:
+                p['merged'] = True
+                p['state'] = 'closed'
+                p['updated_at'] = self._tick()
+        url = f'{self.base_url}/repos/{OWNER}/{REPO}/pulls/{p["number"]}'
+        user = dict(p['user'], url=f'{self.base_url}/users/{p["user"]["login"]}')
+        return {
+            'url': url, 'id': p['number'], 'number': p['number'], 'title': p['title'], 'state': p['state'],
+            'merged': p['merged'], 'mergeable': True, 'rebaseable': True, 'mergeable_state': 'clean',
+            'user': user, 'updated_at': p['updated_at'], 'created_at': '2024-01-01T00:00:00Z',
+            'merged_at': p['updated_at'] if p['merged'] else None, 'draft': False,
+            'labels': [{'name': label} for label in p['labels']],
+            'head': {'ref': p['head'], 'sha': head_sha, 'label': f'{p["head_repo"].split("/")[0]}:{p["head"]}',
+                     'repo': {'full_name': p['head_repo'], 'url': f'{self.base_url}/repos/{p["head_repo"]}'}},
+            'base': {'ref': p['base'], 'sha': base_sha, 'label': f'{OWNER}:{p["base"]}'},
+        }
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, headers=None):
+                data = json.dumps(body).encode()
+                etag = '"%s"' % hashlib.sha1(data).hexdigest()
+                if status == 200 and self.command == 'GET':
+                    headers = dict(headers or {}, ETag=etag)
+                    if self.headers.get('If-None-Match') == etag:
+                        fake.not_modified += 1
+                        self.send_response(304)
+                        self.send_header('ETag', etag)
+                        self.send_header('X-RateLimit-Limit', '5000')
+                        self.send_header('X-RateLimit-Remaining', '4999')
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('X-RateLimit-Limit', '5000')
+                self.send_header('X-RateLimit-Remaining', '4999')
+                self.send_header('X-RateLimit-Reset', '0')
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _body(self):
+                n = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(n) or b'{}')
+
+            def _route(self, verb):
+                u = urlparse(self.path)
+                q = {k: v[0] for k, v in parse_qs(u.query).items()}
+                fake.requests.append((verb, self.path))
+                if fake.latency:
+                    time.sleep(fake.latency)
+                with fake.lock:
+                    return self._dispatch(verb, u.path, q)
+
+            def _dispatch(self, verb, path, q):
+                repo_prefix = f'/repos/{OWNER}/{REPO}'
+                if path in ('/', ''):
+                    return self._send(200, {})
+                if path == '/graphql' and verb == 'POST':
+                    variables = self._body().get('variables', {})
+                    if 'number' in variables:
+                        p = fake.pulls[variables['number']]
+                        pull = fake._pull_json(p)
+                        node = {'state': 'MERGED' if pull['merged'] else pull['state'].upper(), 'isDraft': False,
+                                'headRefOid': pull['head']['sha'], 'labels': {'nodes': pull['labels']},
+                                'commits': {'nodes': [{'commit': {'statusCheckRollup': {'state': p['ci_status']}}}]}}
+                        return self._send(200, {'data': {'repository': {'pullRequest': node}}})
+                    pulls = [fake._pull_json(p) for p in fake.pulls.values()]
+                    pulls = [p for p in pulls if p['state'] == 'open']
+                    if 'search' in variables:
+                        pulls = [p for p in pulls if p['user']['login'] == USER['login']]
+                    pulls.sort(key=lambda p: p['number'], reverse=True)
+                    start = int(variables.get('cursor') or 0)
+                    first = int(variables.get('first', 100))
+                    chunk = pulls[start:start + first]
+                    nodes = [{'number': p['number'], 'title': p['title'], 'headRefName': p['head']['ref'],
+                              'headRepository': {'nameWithOwner': p['head']['repo']['full_name']},
+                              'baseRefName': p['base']['ref'], 'mergeable': 'MERGEABLE', 'reviewDecision': 'APPROVED',
+                              'commits': {'nodes': [{'commit': {'statusCheckRollup': {'state': 'SUCCESS'}}}]}} for p in chunk]
+                    connection = {'pageInfo': {'hasNextPage': start + first < len(pulls), 'endCursor': str(start + first)}, 'nodes': nodes}
+                    data = {'search': connection} if 'search' in variables else {'repository': {'pullRequests': connection}}
+                    return self._send(200, {'data': data})
+                if path == '/user':
+                    return self._send(200, dict(USER, url=f'{fake.base_url}/users/{USER["login"]}'))
+                m = re.match(r'^/users/([^/]+)$', path)
+                if m:
+                    return self._send(200, dict(USER, login=m.group(1)))
+                if path == repo_prefix:
+                    return self._send(200, {'id': 1, 'name': REPO, 'full_name': f'{OWNER}/{REPO}',
+                                            'url': f'{fake.base_url}{repo_prefix}', 'owner': USER})
+                if path == f'{repo_prefix}/pulls' and verb == 'GET':
+                    pulls = [fake._pull_json(p) for p in fake.pulls.values()]
+                    state = q.get('state', 'open')
+                    if state != 'all':
+                        pulls = [p for p in pulls if p['state'] == state]
+                    if 'base' in q:
+                        pulls = [p for p in pulls if p['base']['ref'] == q['base']]
+                    if 'head' in q:
+                        pulls = [p for p in pulls if p['head']['label'] == q['head']]
+                    sort_key = 'updated_at' if q.get('sort') == 'updated' else 'number'
+                    pulls.sort(key=lambda p: p[sort_key], reverse=q.get('direction', 'asc') == 'desc')
+                    per_page = int(q.get('per_page', 30))
+                    page = int(q.get('page', 1))
+                    chunk = pulls[(page - 1) * per_page:page * per_page]
+                    headers = {}
+                    last = max(1, (len(pulls) + per_page - 1) // per_page)
+                    links = []
+                    base = f'{fake.base_url}{path}?' + '&'.join(f'{k}={v}' for k, v in q.items() if k != 'page')
+                    if page < last:
+                        links.append(f'<{base}&page={page + 1}>; rel="next"')
+                        links.append(f'<{base}&page={last}>; rel="last"')
+                    if links:
+                        headers['Link'] = ', '.join(links)
+                    return self._send(200, chunk, headers)
+                m = re.match(rf'^{repo_prefix}/commits/([0-9a-f]+)(/pulls)?$', path)
+                if m and verb == 'GET':
+                    sha = m.group(1)
+                    if not m.group(2):
+                        return self._send(200, {'sha': sha, 'url': f'{fake.base_url}{repo_prefix}/commits/{sha}'})
+                    pulls = [fake._pull_json(p) for p in fake.pulls.values()]
+                    return self._send(200, [p for p in pulls if p['head']['sha'] == sha])
+                m = re.match(rf'^{repo_prefix}/pulls/(\d+)(/merge)?$', path)
+                if m:
+                    number = int(m.group(1))
+                    p = fake.pulls.get(number)
+                    if not p:
+                        return self._send(404, {'message': 'Not Found'})
+                    if m.group(2) and verb == 'PUT':
+                        body = self._body()
+                        base_sha = fake._sha(p['base'])
+                        head_sha = fake._sha(p['head'])
+                        tree = git(fake.bare, 'merge-tree', '--write-tree', base_sha, head_sha)
+                        msg = body.get('commit_title', '') + ('\n\n' + body['commit_message'] if body.get('commit_message') else '')
+                        sha = git(fake.bare, 'commit-tree', tree, '-p', base_sha, '-m', msg or 'squash')
+                        git(fake.bare, 'update-ref', f'refs/heads/{p["base"]}', sha)
+                        p['merged'] = True
+                        p['state'] = 'closed'
+                        p['updated_at'] = fake._tick()
+                        return self._send(200, {'sha': sha, 'merged': True, 'message': 'merged'})
+                    if verb == 'PATCH':
+                        body = self._body()
+                        if 'base' in body:
+                            p['base'] = body['base']
+                        if 'title' in body:
+                            p['title'] = body['title']
+                        p['updated_at'] = fake._tick()
+                    return self._send(200, fake._pull_json(p))
+                return self._send(404, {'message': f'Not Found {path}'})
+
+            def do_GET(self):
+                self._route('GET')
+
+            def do_PATCH(self):
+                self._route('PATCH')
+
+            def do_PUT(self):
+                self._route('PUT')
+
+            def do_POST(self):
+                self._route('POST')
+
+        return Handler
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""Time and api requests of answering a filtered `git pr list --base BRANCH`, live versus from the local pull request index.
+
+Live means paging through all open pull requests, like `git pr list` does. The index is measured on its first sync, on
+an incremental sync after a few pull requests changed, and while it's still fresh (within the TTL).
+
+Usage: python benchmarks/pull_index.py [--open-prs N] [--changed-prs N] [--api-latency-ms N]
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import subprocess
+import tempfile
+import contextlib
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARKS_DIR), 'src'))
+
+from fake_github import FakeGithub, OWNER, REPO
+
+
+def measure(server, fn):
+    num_requests_before = len(server.requests)
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        fn()
+    return (time.perf_counter() - start) * 1000, len(server.requests) - num_requests_before
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Benchmark filtered pull request listing, live versus indexed')
+    parser.add_argument('--open-prs', type=int, default=500, help='number of open pull requests')
+    parser.add_argument('--changed-prs', type=int, default=5, help='number of pull requests changed before the incremental sync')
+    parser.add_argument('--api-latency-ms', type=int, default=50, help='delay of every api response, to simulate the round trip to github.com')
+    args = parser.parse_args()
+
+    from github import Github
+    from git_pr_linear_merge import main, cache, cfg
+    import configparser
+    logging.getLogger().setLevel(logging.CRITICAL + 1)
+    cache.install(None)
+
+    root = tempfile.mkdtemp(prefix='git-pr-bench-index-')
+    # The index lives in the home directory
+    os.environ['HOME'] = root
+    server = None
+    try:
+        bare = os.path.join(root, 'origin.git')
+        subprocess.run(['git', 'init', '-q', '--bare', '-b', 'main', bare], check=True)
+        server = FakeGithub(bare, args.api_latency_ms / 1000).start()
+        for number in range(1, args.open_prs + 1):
+            server.add_pull(number, f'feature/{number}', 'release/3.2' if number % 10 == 0 else 'main')
+        github = Github('benchmark-token', base_url=server.base_url, per_page=main.API_PAGE_SIZE)
+        github_repo = github.get_repo(f'{OWNER}/{REPO}')
+        index_config = cfg.IndexConfig(configparser.ConfigParser())
+
+        def list_indexed():
+            main.filtered_list_command(github, github_repo, index_config, base_ref='release/3.2')
+
+        results = [('live', measure(server, lambda: main.list_command(github, github_repo)))]
+        index_config.ttl_seconds = 0
+        results.append(('index first sync', measure(server, list_indexed)))
+        for number in range(1, args.changed_prs + 1):
+            github_repo.get_pull(number).edit(base='release/3.2')
+        results.append(('index incremental', measure(server, list_indexed)))
+        index_config.ttl_seconds = 60
+        results.append(('index fresh', measure(server, list_indexed)))
+    finally:
+        if server is not None:
+            server.stop()
+        shutil.rmtree(root, ignore_errors=True)
+
+    for name, (duration_ms, num_requests) in results:
+        print(f'{name:20} {duration_ms:10.1f} ms {num_requests:6} api requests')
+
+
+if __name__ == '__main__':
+    run()
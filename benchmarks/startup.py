@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""Import-time and cold-start benchmark for the `git pr` entry point.
+
+Usage: python benchmarks/startup.py [--runs N]
+"""
+
+import os
+import re
+import sys
+import time
+import json
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(REPO_DIR, 'src')
+GIT_PR_SCRIPT = os.path.join(REPO_DIR, 'git-pr.py')
+HEAVY_MODULES = ['git', 'github', 'requests', 'tabulate']
+
+
+def _env(**extra):
+    env = dict(os.environ, PYTHONPATH=SRC_DIR, **extra)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+def import_time_ms():
+    # Cumulative import time of the entry point module, as reported by `python -X importtime`
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import git_pr_linear_merge.main'],
+        env=_env(), capture_output=True, text=True, check=True)
+    match = re.search(r'import time:\s+\d+ \|\s+(\d+) \| git_pr_linear_merge\.main$', result.stderr, re.MULTILINE)
+    return int(match.group(1)) / 1000
+
+
+def heavy_modules_loaded_for_help():
+    code = ('import sys\n'
+        'from git_pr_linear_merge import main\n'
+        'sys.argv = ["git-pr", "--help"]\n'
+        'try:\n'
+        '    main.run()\n'
+        'except SystemExit:\n'
+        '    pass\n'
+        f'print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules), file=sys.stderr)\n')
+    result = subprocess.run([sys.executable, '-c', code], env=_env(), capture_output=True, text=True)
+    return result.stderr.strip().splitlines()[-1] if result.stderr.strip() else ''
+
+
+def cold_start_ms(args):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, GIT_PR_SCRIPT, *args], env=_env(), capture_output=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def cached_token_validation_ms():
+    # Time spent on authentication when the token was validated recently (no network round trip)
+    with tempfile.TemporaryDirectory() as home_dir:
+        code = ('import time\n'
+            'from git_pr_linear_merge import auth\n'
+            'auth._cache_token_validation("benchmark-token")\n'
+            'start = time.perf_counter()\n'
+            'auth.initial_auth_flow_if_necessary("benchmark-token")\n'
+            'print((time.perf_counter() - start) * 1000)\n')
+        result = subprocess.run([sys.executable, '-c', code], env=_env(HOME=home_dir), capture_output=True, text=True, check=True)
+        return float(result.stdout.strip())
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Benchmark `git pr` import time and cold start')
+    parser.add_argument('--runs', type=int, default=10, help='number of runs per measurement')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    results = {
+        'import_main_ms': statistics.median(import_time_ms() for _ in range(args.runs)),
+        'cold_start_help_ms': statistics.median(cold_start_ms(['--help']) for _ in range(args.runs)),
+        'cold_start_arg_error_ms': statistics.median(cold_start_ms(['merge']) for _ in range(args.runs)),
+        'cached_token_validation_ms': statistics.median(cached_token_validation_ms() for _ in range(args.runs)),
+        'heavy_modules_loaded_for_help': heavy_modules_loaded_for_help(),
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, value in results.items():
+            print(f'{name:32} {value:.1f}' if isinstance(value, float) else f'{name:32} {value or "-"}')
+
+
+if __name__ == '__main__':
+    run()
@@ -1,14 +1,55 @@
-import requests
+import os
+import json
+import time
+import hashlib
 from . import logger
 from . import cfg
 
+AUTH_CACHE_FILE_NAME = '.linmergeauth'
+TOKEN_VALIDATION_TTL_SECONDS = 24 * 60 * 60
 log = logger.logger
 
 
+def _auth_cache_file_path():
+    return os.path.expanduser(f'~/{AUTH_CACHE_FILE_NAME}')
+
+
+def _token_hash(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def _is_token_validation_cached(token):
+    try:
+        with open(_auth_cache_file_path(), 'r') as auth_cache_file:
+            validation = json.load(auth_cache_file)
+    except (OSError, ValueError):
+        return False
+    return (validation.get('token_sha256') == _token_hash(token)
+        and time.time() - validation.get('validated_at', 0) < TOKEN_VALIDATION_TTL_SECONDS)
+
+
+def _cache_token_validation(token):
+    try:
+        with open(_auth_cache_file_path(), 'w') as auth_cache_file:
+            json.dump({'token_sha256': _token_hash(token), 'validated_at': time.time()}, auth_cache_file)
+    except OSError as ex:
+        log.debug(f'Could not cache the token validation: {ex}')
+
+
+def invalidate_token_validation():
+    try:
+        os.remove(_auth_cache_file_path())
+    except OSError:
+        pass
+
+
 def _test_github_auth_token(token):
+    from . import transport
     try:
-        r = requests.get("https://api.github.com", headers={'Authorization': f'token {token}'})
+        r = transport.request('GET', transport.GITHUB_API_URL, headers={'Authorization': f'token {token}'})
         log.debug('Github authentication succeeded')
+        if r.ok:
+            _cache_token_validation(token)
         return r.ok
     except Exception as e:
         log.error(e)
@@ -47,6 +88,10 @@ def initial_auth_flow_if_necessary(github_access_token=None):
         log.error('Could not authenticate because no access token was specified or previously saved.')
         return _new_auth_setup()
 
+    # Skip the round trip if this token was validated recently. Any api call failing authentication invalidates this
+    elif _is_token_validation_cached(github_access_token):
+        log.debug('Github authentication previously validated')
+
     elif not _test_github_auth_token(github_access_token):
         log.error('Github authentication failed')
         return _new_auth_setup()
@@ -0,0 +1,191 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from github.Requester import Requester, RequestsResponse, HTTPRequestsConnectionClass, HTTPSRequestsConnectionClass
+from . import logger
+from . import transport
+
+CACHE_DIR_NAME = '.linmergecache'
+# Eviction makes room for this share of the cache, so the next writes don't evict (and scan the directory) again
+EVICTION_HEADROOM = 0.1
+log = logger.logger
+
+# The active response cache, set by `install`
+_response_cache = None
+
+
+class ResponseCache:
+    """On-disk cache of GitHub API responses, revalidated with conditional requests (ETag / Last-Modified)"""
+
+    def __init__(self, cache_dir, max_size_bytes):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        # Size of all entries, kept up to date as entries are written so the directory is only scanned to evict.
+        # Other processes may write too, so it's an estimate that every eviction corrects.
+        self.total_size = None
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+
+    def _entry_path(self, authorization, accept, url):
+        # Entries are keyed by token and url, so different tokens never see each other's responses. And by the
+        # requested media type, the same url answers with another representation for another Accept header.
+        key = hashlib.sha256(f'{authorization}\n{accept}\n{url}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, authorization, accept, url):
+        entry_path = self._entry_path(authorization, accept, url)
+        try:
+            with open(entry_path, 'r') as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+
+        # Touch the entry so eviction drops the least recently used entries first
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, authorization, accept, url, headers, text):
+        entry = {
+            'etag': headers.get('etag'),
+            'last_modified': headers.get('last-modified'),
+            'headers': headers,
+            'text': text,
+        }
+        data = json.dumps(entry).encode('utf-8')
+        entry_path = self._entry_path(authorization, accept, url)
+        try:
+            replaced_size = os.path.getsize(entry_path)
+        except OSError:
+            replaced_size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as entry_file:
+                entry_file.write(data)
+            os.replace(tmp_path, entry_path)
+        except OSError as ex:
+            log.debug(f'Could not write to the response cache: {ex}')
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        with self.lock:
+            if self.total_size is not None:
+                self.total_size += len(data) - replaced_size
+            if self.total_size is None or self.total_size > self.max_size_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Scans the whole directory, only when the size isn't known yet or went over the limit
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for dir_entry in it:
+                # Skip entries that are still being written
+                if dir_entry.name.startswith('.'):
+                    continue
+                try:
+                    stat = dir_entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        if total_size <= self.max_size_bytes:
+            self.total_size = total_size
+            return
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size_bytes * (1 - EVICTION_HEADROOM):
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError:
+                pass
+        self.total_size = total_size
+
+
+class CachedResponse:
+    # mimic the httplib response object, like github.Requester.RequestsResponse
+    def __init__(self, status, headers, text):
+        self.status = status
+        self.headers = headers
+        self.text = text
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def read(self):
+        return self.text
+
+
+class _CachingConnectionMixin:
+    def __init__(self, host, port=None, strict=False, timeout=None, retry=None, **kwargs):
+        # Like PyGithub's connection classes, without the session they create: requests go through the shared one in
+        # transport, which also retries
+        self.port = port if port else self.default_port
+        self.host = host
+        self.timeout = timeout
+        self.verify = kwargs.get('verify', True)
+
+    def _send(self):
+        # Sent through the shared session and request scheduler instead of a session per connection
+        url = f'{self.protocol}://{self.host}:{self.port}{self.url}'
+        response = transport.request(self.verb, url, headers=self.headers, data=self.input, timeout=self.timeout,
+            verify=self.verify, allow_redirects=False)
+        return RequestsResponse(response)
+
+    def getresponse(self):
+        if self.verb != 'GET' or _response_cache is None:
+            return self._send()
+
+        url = f'{self.protocol}://{self.host}:{self.port}{self.url}'
+        authorization = self.headers.get('Authorization', '')
+        accept = self.headers.get('Accept', '')
+        entry = _response_cache.get(authorization, accept, url)
+        if entry is not None:
+            if entry['etag']:
+                self.headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                self.headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self._send()
+
+        # Not modified: serve the cached body, with the fresh rate limit headers from this response
+        if response.status == 304 and entry is not None:
+            log.debug(f'Not modified, using cached response: GET {self.url}')
+            headers = dict(entry['headers'])
+            headers.update({k.lower(): v for k, v in response.headers.items()})
+            return CachedResponse(200, headers, entry['text'])
+
+        if response.status == 200:
+            headers = {k.lower(): v for k, v in response.headers.items()}
+            if 'etag' in headers or 'last-modified' in headers:
+                _response_cache.put(authorization, accept, url, headers, response.text)
+        return response
+
+
+class CachingHTTPSConnectionClass(_CachingConnectionMixin, HTTPSRequestsConnectionClass):
+    protocol = 'https'
+    default_port = 443
+
+
+class CachingHTTPConnectionClass(_CachingConnectionMixin, HTTPRequestsConnectionClass):
+    protocol = 'http'
+    default_port = 80
+
+
+def default_cache_dir():
+    return os.path.expanduser(f'~/{CACHE_DIR_NAME}')
+
+
+def install(response_cache):
+    # Plug the connection classes in underneath every Github client created after this call, without a cache if None
+    global _response_cache
+    _response_cache = response_cache
+    Requester.injectConnectionClasses(CachingHTTPConnectionClass, CachingHTTPSConnectionClass)
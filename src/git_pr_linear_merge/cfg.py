@@ -21,6 +21,32 @@ class MergeConfig:
     def __init__(self, config):
         self.merge_msg_format = config.get('merge', 'merge_msg_format', fallback=r'Merge: {TITLE} (#{NUMBER})')
         self.always_squash_single_commit_pulls = config.getboolean('merge', 'always_squash_single_commit_pulls', fallback=True)
+        self.no_checkout = config.getboolean('merge', 'no_checkout', fallback=False)
 
         self.squash_msg_format = config.get('squash', 'squash_msg_format', fallback=r'{TITLE} (#{NUMBER})')
         self.squash_cmd_enabled = config.getboolean('squash', 'squash_cmd_enabled', fallback=True)
+
+
+class CacheConfig:
+    def __init__(self, config):
+        self.enabled = config.getboolean('cache', 'enabled', fallback=True)
+        self.max_size_mb = config.getint('cache', 'max_size_mb', fallback=50)
+
+
+class DaemonConfig:
+    def __init__(self, config):
+        self.idle_timeout_minutes = config.getint('daemon', 'idle_timeout_minutes', fallback=30)
+
+
+class IndexConfig:
+    def __init__(self, config):
+        self.ttl_seconds = config.getint('index', 'ttl_seconds', fallback=60)
+
+
+class ServeConfig:
+    def __init__(self, config):
+        self.webhook_secret = config.get('serve', 'webhook_secret', fallback=None)
+        self.host = config.get('serve', 'host', fallback='127.0.0.1')
+        self.port = config.getint('serve', 'port', fallback=8080)
+        self.ready_label = config.get('serve', 'ready_label', fallback='ready-to-merge')
+        self.squash = config.getboolean('serve', 'squash', fallback=False)
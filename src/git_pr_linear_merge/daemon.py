@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+import time
+import array
+import signal
+import socket
+import hashlib
+import threading
+import subprocess
+import colorama
+from . import logger
+
+DAEMON_DIR_NAME = '.linmergedaemon'
+MAX_MESSAGE_SIZE = 1024 * 1024
+START_TIMEOUT_SECONDS = 10
+# The client hands its stdin, stdout and stderr to the daemon, so prompts and colors work like they do in-process
+CLIENT_FDS = (0, 1, 2)
+log = logger.logger
+
+
+def is_supported():
+    return hasattr(socket, 'AF_UNIX')
+
+
+def daemon_dir():
+    return os.path.expanduser(f'~/{DAEMON_DIR_NAME}')
+
+
+def socket_path(repo_dir):
+    # One daemon per repo. The socket lives in a directory only we can access, so only we can send it commands.
+    repo_hash = hashlib.sha256(os.path.realpath(repo_dir).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(daemon_dir(), f'{repo_hash}.sock')
+
+
+def find_repo_dir():
+    result = subprocess.run(['git', 'rev-parse', '--show-toplevel'], capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def _send_message(sock, message, fds=()):
+    data = json.dumps(message).encode('utf-8')
+    ancillary_data = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))] if any(fds) else []
+    sock.sendmsg([data], ancillary_data)
+
+
+def _receive_message(sock, max_fds=0):
+    fds = array.array('i')
+    data, ancillary_data, _, _ = sock.recvmsg(MAX_MESSAGE_SIZE, socket.CMSG_SPACE(max_fds * fds.itemsize))
+    for level, kind, fd_data in ancillary_data:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(fd_data[:len(fd_data) - (len(fd_data) % fds.itemsize)])
+    return (json.loads(data) if data else None), list(fds)
+
+
+def _connect(path):
+    if not is_supported() or not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def forward(argv):
+    # Runs the command in this repo's daemon and returns its exit code, or None if there's no daemon to run it.
+    # Checking for the daemon directory first keeps the cost close to nothing when no daemon was ever started.
+    if not os.path.isdir(daemon_dir()) or not any(os.scandir(daemon_dir())):
+        return None
+    repo_dir = find_repo_dir()
+    sock = _connect(socket_path(repo_dir)) if repo_dir else None
+    if sock is None:
+        return None
+
+    with sock:
+        log.debug('Running the command in the daemon')
+        sys.stdout.flush()
+        sys.stderr.flush()
+        _send_message(sock, {'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}, CLIENT_FDS)
+        while True:
+            try:
+                reply, _ = _receive_message(sock)
+                break
+            except KeyboardInterrupt:
+                # Interrupt the command in the daemon too, and wait for it to clean up
+                sock.send(b'\0')
+        if reply is None:
+            log.error('The daemon stopped before the command finished')
+            return 1
+        return reply['exit_code']
+
+
+def send_control(path, control):
+    # Sends a control message (`status` or `stop`) to a daemon, returns its reply or None if it isn't running
+    sock = _connect(path)
+    if sock is None:
+        return None
+    with sock:
+        _send_message(sock, {'control': control})
+        reply, _ = _receive_message(sock)
+        return reply
+
+
+def _exit_code(system_exit):
+    if system_exit.code is None or isinstance(system_exit.code, int):
+        return system_exit.code or 0
+    return 1
+
+
+def _rewrap_colorama_streams():
+    colorama.deinit()
+    colorama.init(autoreset=True)
+
+
+def _run_with_client_fds(connection, client_fds, request, handle_command):
+    # Runs a command as if it were the client process: with its stdin/stdout/stderr, working directory and environment
+    saved_fds = [os.dup(fd) for fd in CLIENT_FDS]
+    saved_cwd = os.getcwd()
+    saved_environ = dict(os.environ)
+    finished = threading.Event()
+
+    def watch_client():
+        # The client sends a byte when it's interrupted (Ctrl-C), or goes away. Interrupt the command too, which
+        # unwinds its undo stack just like it does in-process.
+        try:
+            connection.recv(1)
+        except OSError:
+            pass
+        if not finished.is_set():
+            signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+
+    try:
+        for fd, client_fd in zip(CLIENT_FDS, client_fds):
+            os.dup2(client_fd, fd)
+        # `exit()` closes sys.stdin, so each command gets its own
+        sys.stdin = open(0, 'r', closefd=False)
+        # colorama decides whether to strip colors when it wraps the streams, so they're wrapped again for the client
+        _rewrap_colorama_streams()
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        threading.Thread(target=watch_client, daemon=True).start()
+        try:
+            handle_command(request['argv'])
+            exit_code = 0
+        except SystemExit as system_exit:
+            exit_code = _exit_code(system_exit)
+        except KeyboardInterrupt:
+            exit_code = 130
+        except Exception as ex:
+            log.error(f'An unexpected error occurred: {ex}')
+            exit_code = 1
+    finally:
+        finished.set()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved_fd in zip(CLIENT_FDS, saved_fds):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+        for client_fd in client_fds:
+            os.close(client_fd)
+        _rewrap_colorama_streams()
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        os.chdir(saved_cwd)
+    return exit_code
+
+
+def serve(path, idle_timeout_seconds, handle_command):
+    # Runs commands sent by clients one at a time, until stopped or idle for too long
+    os.makedirs(daemon_dir(), mode=0o700, exist_ok=True)
+    if send_control(path, 'status') is not None:
+        log.error('A daemon is already running for this repository')
+        exit(1)
+    if os.path.exists(path):
+        os.remove(path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen()
+    server.settimeout(idle_timeout_seconds)
+    started_at = time.time()
+    num_commands = 0
+    log.info(f'Daemon listening on {path}, stopping after {idle_timeout_seconds // 60} minutes without commands')
+    try:
+        while True:
+            try:
+                connection, _ = server.accept()
+            except socket.timeout:
+                log.info('Daemon idle, stopping')
+                break
+
+            with connection:
+                connection.settimeout(None)
+                request, client_fds = _receive_message(connection, len(CLIENT_FDS))
+                if request is None:
+                    continue
+                if request.get('control') == 'stop':
+                    _send_message(connection, {'stopped': True})
+                    break
+                if request.get('control') == 'status':
+                    _send_message(connection, {'pid': os.getpid(), 'uptime_seconds': int(time.time() - started_at),
+                        'commands': num_commands, 'idle_timeout_seconds': idle_timeout_seconds})
+                    continue
+
+                num_commands += 1
+                exit_code = _run_with_client_fds(connection, client_fds, request, handle_command)
+                try:
+                    _send_message(connection, {'exit_code': exit_code})
+                except OSError:
+                    pass
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def spawn(path, argv):
+    # Starts the daemon in the background, detached from the terminal. Returns once it accepts commands, or False if it
+    # didn't come up.
+    process = subprocess.Popen([sys.executable, '-c', 'from git_pr_linear_merge.main import run; run()', *argv],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True,
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    deadline = time.monotonic() + START_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        if send_control(path, 'status') is not None:
+            return True
+        if process.poll() is not None:
+            return False
+        time.sleep(0.05)
+    return False
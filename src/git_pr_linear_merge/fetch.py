@@ -0,0 +1,163 @@
+import os
+import tempfile
+from . import logger
+
+# Shallow clones are deepened by this many commits at first, doubling until the branches' fork point is found
+DEEPEN_INITIAL_DEPTH = 64
+DEEPEN_MAX_ATTEMPTS = 6
+NULL_OID = '0' * 40
+log = logger.logger
+
+
+class RemoteFetcher:
+    """Fetches only the refs an operation touches, remembering what was already fetched during this run"""
+
+    def __init__(self, git_repo, remote_name='origin'):
+        self.git_repo = git_repo
+        self.remote_name = remote_name
+        self.fetched_refs = set()
+        self.fetched_pull_numbers = set()
+        # Shallow clones lack old history and partial clones lack blobs, both are fetched in bulk before rebasing
+        self.is_shallow = os.path.exists(os.path.join(git_repo.common_dir, 'shallow'))
+        self.is_partial = bool(git_repo.config_reader().get_value(f'remote "{remote_name}"', 'promisor', False))
+
+    def tracking_ref(self, branch):
+        return f'refs/remotes/{self.remote_name}/{branch}'
+
+    def pull_ref(self, pull_number):
+        # Outside refs/remotes, so they can't clash with a remote branch named `pr` or show up as remote branches
+        return f'refs/git-pr/pull/{pull_number}'
+
+    def fetch(self, branches=(), pull_numbers=(), refresh=False, shallow_exclude=()):
+        # Refs fetched earlier in this run are skipped, unless we need to know whether the remote moved since.
+        # Tags aren't followed, otherwise the remote advertises every tag it has.
+        refspecs = {}
+        for branch in branches:
+            refspecs[f'refs/heads/{branch}'] = self.tracking_ref(branch)
+        for pull_number in pull_numbers:
+            refspecs[f'refs/pull/{pull_number}/head'] = self.pull_ref(pull_number)
+        if not refresh:
+            refspecs = {src: dst for src, dst in refspecs.items() if src not in self.fetched_refs}
+        if not any(refspecs):
+            log.debug('Already fetched, skipping fetch')
+            return
+
+        shallow_exclude_args = [f'--shallow-exclude={branch}' for branch in shallow_exclude]
+        self.git_repo.git.fetch(self.remote_name, '--no-tags', *shallow_exclude_args, *[f'+{src}:{dst}' for src, dst in refspecs.items()])
+        self.fetched_refs.update(refspecs)
+        self.fetched_pull_numbers.update(pull_number for pull_number in pull_numbers if f'refs/pull/{pull_number}/head' in refspecs)
+
+    def fetch_for_rebase(self, pulls):
+        # Fetches what rebasing pull requests onto their base needs, pulls are (base branch, head branch, number).
+        # The head branch is optional, the pull request's head ref is always fetched.
+        import git
+
+        base_branches = sorted({base_branch for base_branch, _, _ in pulls})
+        head_branches = [head_branch for _, head_branch, _ in pulls if head_branch]
+        pull_numbers = [pull_number for _, _, pull_number in pulls]
+        if not self.is_shallow:
+            self.fetch(base_branches + head_branches, pull_numbers)
+        else:
+            # In a shallow clone, fetching a branch brings its whole history down to the shallow boundary, and past it
+            # when the branch forked before it. Only fetch the pull request commits, then deepen until they connect.
+            self.fetch(base_branches)
+            try:
+                self.fetch(head_branches, pull_numbers, shallow_exclude=base_branches)
+            except git.GitCommandError as command_error:
+                log.debug(f'Could not fetch only the pull request commits: {command_error}')
+                self.fetch(head_branches, pull_numbers)
+            self._deepen_until_forked([(self.tracking_ref(base_branch), self.pull_ref(pull_number)) for base_branch, _, pull_number in pulls])
+
+        if self.is_partial:
+            self._prefetch_blobs([(self.tracking_ref(base_branch), self.pull_ref(pull_number)) for base_branch, _, pull_number in pulls])
+
+    def _merge_base(self, base, head):
+        status, merge_base, _ = self.git_repo.git.merge_base(base, head, with_extended_output=True, with_exceptions=False)
+        return merge_base if status == 0 else None
+
+    def _deepen_until_forked(self, rebases):
+        # Rebasing needs the commit the branches forked from, which may be past the shallow boundary
+        depth = DEEPEN_INITIAL_DEPTH
+        for _ in range(DEEPEN_MAX_ATTEMPTS):
+            if all(self._merge_base(base, head) for base, head in rebases):
+                return
+            log.info(f'Deepening the shallow history by {depth} commits')
+            self.git_repo.git.fetch(self.remote_name, '--no-tags', f'--deepen={depth}', *sorted(self.fetched_refs))
+            depth *= 2
+        if not all(self._merge_base(base, head) for base, head in rebases):
+            log.info('Fetching the full history, the branches forked too long ago')
+            self.git_repo.git.fetch(self.remote_name, '--no-tags', '--unshallow', *sorted(self.fetched_refs))
+
+    def _changed_blobs(self, revision_range, paths=()):
+        # Blobs before and after every change in the range, and the paths they're at. Raw diffs only compare the ids in
+        # trees, they never read blobs.
+        blobs = set()
+        changed_paths = set()
+        raw_log = self.git_repo.git.log('--format=', '--raw', '--no-renames', '--no-abbrev', '-z', revision_range, '--',
+            *paths, env={'GIT_LITERAL_PATHSPECS': '1'})
+        fields = iter(raw_log.split('\0'))
+        for field in fields:
+            # `:old_mode new_mode old_blob new_blob status`, followed by the path
+            if not field.strip().startswith(':'):
+                continue
+            _, _, old_blob, new_blob, _ = field.strip().split(' ')
+            blobs.update(blob for blob in (old_blob, new_blob) if blob != NULL_OID)
+            changed_paths.add(next(fields))
+        return blobs, changed_paths
+
+    def _prefetch_blobs(self, rebases):
+        # A partial clone fetches each missing blob on its own when a command reads it, which is very slow during a
+        # rebase. Fetch every blob the rebases will read in one request instead: all versions of the files the pull
+        # request changes, on both sides since the fork point.
+        blobs = set()
+        for base, head in rebases:
+            merge_base = self._merge_base(base, head)
+            if merge_base is None:
+                continue
+            head_blobs, head_paths = self._changed_blobs(f'{merge_base}..{head}')
+            blobs.update(head_blobs)
+            if any(head_paths):
+                base_blobs, _ = self._changed_blobs(f'{merge_base}..{base}', sorted(head_paths))
+                blobs.update(base_blobs)
+        if not any(blobs):
+            return
+
+        # `rev-list --missing=print` tells which objects are missing without fetching them. It doesn't take blobs, so
+        # they're put in a tree, which doesn't need them to be there.
+        with _text_stream(''.join(f'100644 blob {blob}\t{i}\n' for i, blob in enumerate(sorted(blobs)))) as tree_entries:
+            blobs_tree = self.git_repo.git.mktree('--missing', istream=tree_entries)
+        objects = self.git_repo.git.rev_list('--objects', '--missing=print', blobs_tree)
+        missing_blobs = [line[1:] for line in objects.splitlines() if line.startswith('?')]
+        if not any(missing_blobs):
+            return
+
+        # The same request git makes to fetch a missing object, with all of them at once
+        log.info(f'Fetching {len(missing_blobs)} missing files')
+        with _text_stream(''.join(f'{blob}\n' for blob in missing_blobs)) as blob_ids:
+            self.git_repo.git.execute(['git', '-c', 'fetch.negotiationAlgorithm=noop', 'fetch', self.remote_name, '--no-tags',
+                '--no-write-fetch-head', '--recurse-submodules=no', '--filter=blob:none', '--stdin'], istream=blob_ids)
+
+    def delete_pull_refs(self):
+        # The pull request heads are only needed while this run looks at them, none are left behind
+        if not any(self.fetched_pull_numbers):
+            return
+        with _text_stream(''.join(f'delete {self.pull_ref(pull_number)}\n' for pull_number in sorted(self.fetched_pull_numbers))) as commands:
+            self.git_repo.git.update_ref('--stdin', istream=commands)
+        self.fetched_refs.difference_update(f'refs/pull/{pull_number}/head' for pull_number in self.fetched_pull_numbers)
+        self.fetched_pull_numbers = set()
+
+    def mark_pushed(self, branch):
+        # Pushing updates the tracking ref as well, so there's no need to fetch it again
+        self.fetched_refs.add(f'refs/heads/{branch}')
+
+    def update_local_branch(self, branch):
+        # Fast-forwards (or creates) the local branch to its fetched tracking ref, without touching the network
+        self.git_repo.git.fetch('.', f'{self.tracking_ref(branch)}:refs/heads/{branch}')
+
+
+def _text_stream(text):
+    # git reads its input from a file, so large inputs don't need to fit in a pipe buffer
+    stream = tempfile.TemporaryFile()
+    stream.write(text.encode('utf-8'))
+    stream.seek(0)
+    return stream
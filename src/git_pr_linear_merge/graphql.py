@@ -0,0 +1,127 @@
+from . import logger
+
+log = logger.logger
+
+PAGE_SIZE = 100
+
+PULL_FIELDS = '''
+    number
+    title
+    headRefName
+    headRepository {
+      nameWithOwner
+    }
+    baseRefName
+    mergeable
+    reviewDecision
+    commits(last: 1) {
+      nodes {
+        commit {
+          statusCheckRollup {
+            state
+          }
+        }
+      }
+    }
+'''
+
+OPEN_PULLS_QUERY = '''
+query($owner: String!, $name: String!, $first: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(states: OPEN, first: $first, after: $cursor, orderBy: {field: CREATED_AT, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes { %s }
+    }
+  }
+}
+''' % PULL_FIELDS
+
+# The search api filters by author on the server, so we only download our own pull requests
+MY_OPEN_PULLS_QUERY = '''
+query($search: String!, $first: Int!, $cursor: String) {
+  search(query: $search, type: ISSUE, first: $first, after: $cursor) {
+    pageInfo { hasNextPage endCursor }
+    nodes { ... on PullRequest { %s } }
+  }
+}
+''' % PULL_FIELDS
+
+PULL_READINESS_QUERY = '''
+query($owner: String!, $name: String!, $number: Int!) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      state
+      isDraft
+      headRefOid
+      labels(first: 100) { nodes { name } }
+      commits(last: 1) { nodes { commit { statusCheckRollup { state } } } }
+    }
+  }
+}
+'''
+
+
+class GraphQLError(Exception):
+    pass
+
+
+def query(requester, query, variables):
+    _, data = requester.requestJsonAndCheck('POST', '/graphql', input={'query': query, 'variables': variables})
+    if data.get('errors'):
+        raise GraphQLError('; '.join(error.get('message', str(error)) for error in data['errors']))
+    return data['data']
+
+
+def _pull_row(node):
+    ci_status = None
+    commit_nodes = node['commits']['nodes']
+    if any(commit_nodes) and commit_nodes[0]['commit']['statusCheckRollup']:
+        ci_status = commit_nodes[0]['commit']['statusCheckRollup']['state']
+    return {
+        'number': node['number'],
+        'title': node['title'],
+        'head_ref': node['headRefName'],
+        'head_repo': node['headRepository']['nameWithOwner'] if node['headRepository'] else None,
+        'base_ref': node['baseRefName'],
+        'mergeable': node['mergeable'],
+        'review_decision': node['reviewDecision'],
+        'ci_status': ci_status,
+    }
+
+
+def iter_open_pull_pages(github_repo, only_mine=False, page_size=PAGE_SIZE):
+    # Yields a list of pull request rows per page, newest first. Pages are only requested as they're consumed.
+    owner, name = github_repo.full_name.split('/')
+    if only_mine:
+        graphql_query = MY_OPEN_PULLS_QUERY
+        variables = {'search': f'repo:{owner}/{name} is:pr is:open author:@me sort:created-desc'}
+    else:
+        graphql_query = OPEN_PULLS_QUERY
+        variables = {'owner': owner, 'name': name}
+
+    cursor = None
+    while True:
+        data = query(github_repo._requester, graphql_query, dict(variables, first=page_size, cursor=cursor))
+        connection = data['search'] if only_mine else data['repository']['pullRequests']
+        yield [_pull_row(node) for node in connection['nodes'] if node]
+        if not connection['pageInfo']['hasNextPage']:
+            break
+        cursor = connection['pageInfo']['endCursor']
+
+
+def pull_readiness(github_repo, pull_number):
+    # State, labels and the combined status of all checks of one pull request, in a single request
+    owner, name = github_repo.full_name.split('/')
+    data = query(github_repo._requester, PULL_READINESS_QUERY, {'owner': owner, 'name': name, 'number': pull_number})
+    node = data['repository']['pullRequest']
+    ci_status = None
+    commit_nodes = node['commits']['nodes']
+    if any(commit_nodes) and commit_nodes[0]['commit']['statusCheckRollup']:
+        ci_status = commit_nodes[0]['commit']['statusCheckRollup']['state']
+    return {
+        'state': node['state'],
+        'is_draft': node['isDraft'],
+        'head_sha': node['headRefOid'],
+        'labels': {label['name'] for label in node['labels']['nodes']},
+        'ci_status': ci_status,
+    }
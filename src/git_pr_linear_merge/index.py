@@ -0,0 +1,108 @@
+import os
+import time
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from . import logger
+
+INDEX_FILE_NAME = '.linmergeindex.sqlite'
+# Bump when the tables change, older indexes are dropped and synced again from scratch
+SCHEMA_VERSION = 1
+# Github's timestamp format, these compare correctly as strings
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+log = logger.logger
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pulls (
+    repo TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    author TEXT,
+    head_ref TEXT NOT NULL,
+    head_sha TEXT,
+    base_ref TEXT NOT NULL,
+    base_sha TEXT,
+    state TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (repo, number)
+);
+CREATE INDEX IF NOT EXISTS pulls_by_base ON pulls (repo, state, base_ref);
+CREATE INDEX IF NOT EXISTS pulls_by_head ON pulls (repo, state, head_ref);
+CREATE INDEX IF NOT EXISTS pulls_by_author ON pulls (repo, state, author);
+CREATE TABLE IF NOT EXISTS syncs (
+    repo TEXT PRIMARY KEY,
+    last_updated_at TEXT,
+    synced_at REAL NOT NULL
+);
+'''
+
+
+def default_index_path():
+    return os.path.expanduser(f'~/{INDEX_FILE_NAME}')
+
+
+def _format_timestamp(timestamp):
+    return timestamp.strftime(TIMESTAMP_FORMAT) if timestamp else None
+
+
+class PullIndex:
+    """Local SQLite index of pull request metadata, kept up to date incrementally from the pulls api sorted by update"""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, timeout=10)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            if self.connection.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                self.connection.executescript('DROP TABLE IF EXISTS pulls; DROP TABLE IF EXISTS syncs;')
+                self.connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def sync(self, github_repo, ttl_seconds):
+        # Fetches the pull requests updated since the last sync, unless that was less than ttl_seconds ago.
+        # Pages are sorted by most recently updated, so we stop at the first pull request we already have.
+        repo = github_repo.full_name
+        sync_row = self.connection.execute('SELECT * FROM syncs WHERE repo = ?', (repo,)).fetchone()
+        if sync_row is not None and time.time() - sync_row['synced_at'] < ttl_seconds:
+            log.debug(f'Pull request index of {repo} is fresh, not syncing')
+            return
+
+        last_updated_at = sync_row['last_updated_at'] if sync_row is not None else None
+        synced_at = time.time()
+        # The first sync only needs open pull requests, later ones also need those closed since, to drop them
+        pulls = github_repo.get_pulls(state='all' if last_updated_at else 'open', sort='updated', direction='desc')
+        rows = []
+        newest_updated_at = last_updated_at
+        for pull in pulls:
+            updated_at = _format_timestamp(pull.updated_at)
+            # Timestamps have a one second resolution, so pull requests updated in the same second are fetched again
+            if last_updated_at is not None and updated_at < last_updated_at:
+                break
+            rows.append((repo, pull.number, pull.title, pull.user.login if pull.user else None, pull.head.ref,
+                pull.head.sha, pull.base.ref, pull.base.sha, 'merged' if pull.merged_at else pull.state,
+                _format_timestamp(pull.created_at), updated_at))
+            newest_updated_at = max(newest_updated_at or updated_at, updated_at)
+
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO pulls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.connection.execute('INSERT OR REPLACE INTO syncs VALUES (?, ?, ?)', (repo, newest_updated_at, synced_at))
+        log.debug(f'Synced {len(rows)} updated pull requests of {repo} into the index')
+
+    def open_pulls(self, repo, base_ref=None, head_ref=None, author=None, stale_days=None, limit=None):
+        # Open pull requests matching all the given filters, newest first, at most `limit` of them
+        conditions = ['repo = ?', "state = 'open'"]
+        params = [repo]
+        for column, value in [('base_ref', base_ref), ('head_ref', head_ref), ('author', author)]:
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                params.append(value)
+        if stale_days is not None:
+            conditions.append('updated_at < ?')
+            params.append(_format_timestamp(datetime.now(timezone.utc) - timedelta(days=stale_days)))
+        query = f'SELECT * FROM pulls WHERE {" AND ".join(conditions)} ORDER BY number DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        return [dict(row) for row in self.connection.execute(query, params)]
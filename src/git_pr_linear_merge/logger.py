@@ -1,4 +1,8 @@
+import json
+import time
 import logging
+import threading
+from contextlib import contextmanager
 from colorama import Fore, Back, Style
 
 logger = logging.getLogger()
@@ -23,6 +27,177 @@ class CustomFormatter(logging.Formatter):
 def setup_logging(level):
     global logger
     logger.setLevel(level)
+    # Setting up again (for every command the daemon runs) replaces the handler
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
     logger_streamhandler = logging.StreamHandler()
     logger_streamhandler.setFormatter(CustomFormatter())
-    logger.addHandler(logger_streamhandler)
\ No newline at end of file
+    logger.addHandler(logger_streamhandler)
+
+
+# Tracing: nested spans with wall time, git commands and http requests, enabled with `--profile`
+tracer = None
+
+
+class Span:
+    def __init__(self, name, parent, is_phase=False):
+        self.name = name
+        self.is_phase = is_phase
+        self.depth = parent.depth + 1 if parent else 0
+        self.start = time.perf_counter()
+        self.end = None
+        self.git_commands = 0
+        self.git_seconds = 0.0
+        self.http_requests = 0
+        self.http_bytes = 0
+        self.rate_limit_remaining = None
+
+    @property
+    def seconds(self):
+        return (self.end or time.perf_counter()) - self.start
+
+
+class Tracer:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.spans = []
+        self.stack = []
+        self.events = []
+        self.thread_ids = {}
+
+    def _tid(self):
+        return self.thread_ids.setdefault(threading.get_ident(), len(self.thread_ids) + 1)
+
+    def _us(self, seconds):
+        return int((seconds - self.start) * 1000000)
+
+    def _add_event(self, name, category, start, end, args=None):
+        self.events.append({
+            'name': name, 'cat': category, 'ph': 'X', 'pid': 1, 'tid': self._tid(),
+            'ts': self._us(start), 'dur': int((end - start) * 1000000), 'args': args or {},
+        })
+
+    def begin(self, name, is_phase=False):
+        with self.lock:
+            span = Span(name, self.stack[-1] if any(self.stack) else None, is_phase)
+            self.spans.append(span)
+            self.stack.append(span)
+            return span
+
+    def end(self, span):
+        # Ending a span ends any phases that are still open inside of it
+        with self.lock:
+            if span not in self.stack:
+                return
+            while any(self.stack):
+                open_span = self.stack.pop()
+                open_span.end = time.perf_counter()
+                self._add_event(open_span.name, 'phase' if open_span.is_phase else 'span', open_span.start, open_span.end, {
+                    'git_commands': open_span.git_commands,
+                    'http_requests': open_span.http_requests,
+                    'http_bytes': open_span.http_bytes,
+                    'rate_limit_remaining': open_span.rate_limit_remaining,
+                })
+                if open_span is span:
+                    break
+
+    def phase(self, name):
+        # Ends the previous phase of the current span and starts the next one
+        if any(self.stack) and self.stack[-1].is_phase:
+            self.end(self.stack[-1])
+        self.begin(name, is_phase=True)
+
+    def end_all(self):
+        if any(self.stack):
+            self.end(self.stack[0])
+
+    def record_git_command(self, command, start, end):
+        with self.lock:
+            self._add_event(' '.join(str(arg) for arg in command[:2]), 'git', start, end, {'command': ' '.join(str(arg) for arg in command)})
+            for span in self.stack:
+                span.git_commands += 1
+                span.git_seconds += end - start
+
+    def record_http_request(self, verb, url, status, num_bytes, rate_limit_remaining, start, end):
+        with self.lock:
+            self._add_event(f'{verb} {url.split("?")[0]}', 'http', start, end, {
+                'url': url, 'status': status, 'bytes': num_bytes, 'rate_limit_remaining': rate_limit_remaining,
+            })
+            for span in self.stack:
+                span.http_requests += 1
+                span.http_bytes += num_bytes
+                if rate_limit_remaining is not None:
+                    span.rate_limit_remaining = rate_limit_remaining
+
+    def write_chrome_trace(self, path):
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, trace_file)
+
+    def summary_table(self):
+        rows = []
+        for span in self.spans:
+            rows.append([
+                '  ' * span.depth + span.name,
+                f'{span.seconds * 1000:.0f}',
+                span.git_commands,
+                f'{span.git_seconds * 1000:.0f}',
+                span.http_requests,
+                span.http_bytes,
+                '' if span.rate_limit_remaining is None else span.rate_limit_remaining,
+            ])
+        return rows
+
+
+def enable_tracing(name):
+    # Everything that's traced ends up in a root span, which stays open until the profile is written
+    global tracer
+    tracer = Tracer()
+    tracer.begin(name)
+    return tracer
+
+
+@contextmanager
+def span(name):
+    if tracer is None:
+        yield
+        return
+    current_span = tracer.begin(name)
+    try:
+        yield
+    finally:
+        tracer.end(current_span)
+
+
+def phase(name):
+    if tracer is not None:
+        tracer.phase(name)
+
+
+def end_phase():
+    if tracer is not None and any(tracer.stack) and tracer.stack[-1].is_phase:
+        tracer.end(tracer.stack[-1])
+
+
+def trace_git_commands(git_repo_class):
+    # Git commands are traced through GitPython's hook for the command wrapper class of new repos
+    class TracingGit(git_repo_class.GitCommandWrapperType):
+        def execute(self, command, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return super().execute(command, *args, **kwargs)
+            finally:
+                if tracer is not None:
+                    tracer.record_git_command(command if isinstance(command, (list, tuple)) else [command], start, time.perf_counter())
+
+    git_repo_class.GitCommandWrapperType = TracingGit
+
+
+def write_profile(path):
+    import tabulate
+    tracer.end_all()
+    tracer.write_chrome_trace(path)
+    headers = ['Span', 'Wall (ms)', 'Git cmds', 'Git (ms)', 'HTTP reqs', 'HTTP bytes', 'Rate limit left']
+    # Keep the indentation that shows how spans are nested
+    tabulate.PRESERVE_WHITESPACE = True
+    logger.info(f'Profile written to {path} (open it in chrome://tracing or https://ui.perfetto.dev)\n' + tabulate.tabulate(tracer.summary_table(), headers))
@@ -1,391 +1,1340 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import atexit
 import configparser
 import argparse
 import re
-import requests
+import time
+import itertools
 import logging
-import git
 import colorama
 from datetime import datetime
-from github import Github
-from tabulate import tabulate
-from itertools import groupby
 
+# Heavy modules (git, github, requests, tabulate) are imported where they are used, so that `--help`, argument errors
+# and commands that don't need them start fast
 from . import logger
 from . import auth
 from . import cfg
+from . import graphql
+from . import tasks
+from . import fetch
+from . import plumbing
+from . import stats
+from . import daemon
+from . import output
 
 log = logger.logger
 
-def list_command(github, github_repo, only_mine=False):
+PROFILE_FILE_NAME = 'git-pr-profile.json'
+# Polling for mergeability backs off exponentially, in seconds
+MERGEABILITY_POLL_INITIAL_DELAY = 0.5
+MERGEABILITY_POLL_MAX_DELAY = 4
+MERGEABILITY_POLL_TIMEOUT = 30
+
+# The most Github allows, listing pull requests takes as few requests as possible
+API_PAGE_SIZE = 100
+# Pull requests checked at the same time, the work happens in git processes
+CHECK_WORKERS = os.cpu_count() or 4
+
+MERGEABLE_LABELS = {'MERGEABLE': 'yes', 'CONFLICTING': 'conflicts', 'UNKNOWN': '?'}
+REVIEW_DECISION_LABELS = {'APPROVED': 'approved', 'CHANGES_REQUESTED': 'changes requested', 'REVIEW_REQUIRED': 'required'}
+# Columns of `git pr list --format`, the REST api fallback doesn't have the status ones
+LIST_COLUMNS = ['number', 'title', 'head_ref', 'base_ref', 'mergeable', 'review_decision', 'ci_status']
+REST_LIST_COLUMNS = ['number', 'title', 'head_ref', 'base_ref']
+FILTERED_LIST_COLUMNS = ['number', 'title', 'head_ref', 'base_ref', 'author', 'updated_at']
+
+
+def _rest_pull_row(pull):
+    # The head repository is gone when the fork a pull request came from was deleted
+    head_repo = pull.head.repo.full_name if pull.head.repo else None
+    return {'number': pull.number, 'title': pull.title, 'head_ref': pull.head.ref, 'head_repo': head_repo, 'base_ref': pull.base.ref}
+
+
+def _iter_rest_open_pull_pages(github, github_repo, only_mine=False):
+    # Yields a list of pull request rows per page, newest first, like graphql.iter_open_pull_pages
     pulls = github_repo.get_pulls(state='open', sort='created')
-    if only_mine:
-        user_id = github.get_user().id
-        pulls = [pull for pull in pulls if pull.user.id == user_id]
-    pulls_table = [[pull.number, pull.title[:60], pull.head.ref] for pull in pulls]
+    user_id = github.get_user().id if only_mine else None
+    page_number = 0
+    while True:
+        page = pulls.get_page(page_number)
+        yield [_rest_pull_row(pull) for pull in page if user_id is None or pull.user.id == user_id]
+        if len(page) < github.per_page:
+            break
+        page_number += 1
+
+
+def _rest_open_pull_rows(github, github_repo, only_mine=False):
+    return [row for page in _iter_rest_open_pull_pages(github, github_repo, only_mine) for row in page]
+
+
+def _limit_pages(pages, limit):
+    # Stops at the page that brings the number of rows to the limit, the pages after it are never requested
+    num_rows = 0
+    for page in pages:
+        if limit is not None:
+            page = page[:limit - num_rows]
+        num_rows += len(page)
+        yield page
+        if limit is not None and num_rows >= limit:
+            return
+
+
+def _write_rows(output_format, columns, pages):
+    writer = output.RowWriter(output_format, columns)
+    for page in pages:
+        writer.write(page)
+    writer.close()
+
+
+def list_command(github, github_repo, only_mine=False, output_format='table', limit=None):
+    from github import GithubException
+    from tabulate import tabulate
+
+    # GraphQL gets mergeability, reviews and CI status in the same request, and filters by author on the server
+    logger.phase('query')
+    with_status = True
+    pages = graphql.iter_open_pull_pages(github_repo, only_mine, min(limit or graphql.PAGE_SIZE, graphql.PAGE_SIZE))
+    try:
+        first_page = next(pages, [])
+    except (GithubException, graphql.GraphQLError) as ex:
+        log.debug(f'Could not list pull requests through GraphQL, falling back to the REST api: {ex}')
+        with_status = False
+        pages = _iter_rest_open_pull_pages(github, github_repo, only_mine)
+        first_page = next(pages, [])
+    pages = _limit_pages(itertools.chain([first_page], pages), limit)
+
+    # Machine-readable rows are written as their page arrives, with full titles
+    if output_format != 'table':
+        _write_rows(output_format, LIST_COLUMNS if with_status else REST_LIST_COLUMNS, pages)
+        return
+
+    pulls = [row for page in pages for row in page]
+    logger.phase('render')
+    if with_status:
+        pulls_table = [[
+            pull['number'],
+            pull['title'][:60],
+            pull['head_ref'],
+            MERGEABLE_LABELS.get(pull['mergeable'], '?'),
+            REVIEW_DECISION_LABELS.get(pull['review_decision'], '-'),
+            pull['ci_status'].lower() if pull['ci_status'] else '-',
+        ] for pull in pulls]
+        headers = ['#', 'Title', 'Branch', 'Mergeable', 'Review', 'CI']
+    else:
+        pulls_table = [[pull['number'], pull['title'][:60], pull['head_ref']] for pull in pulls]
+        headers = ['#', 'Title', 'Branch']
+
     if any(pulls_table):
-        print('\n' + tabulate(pulls_table, ['#', 'Title', 'Branch']))
+        print('\n' + tabulate(pulls_table, headers))
     else:
         print('No pull requests found')
 
 
-def merge_command(merge_with_squash, git_repo, github_repo, pull_number, merge_config):
-    log.info(f'{colorama.Fore.CYAN}Preparing to merge Pull Request #{pull_number}')
+def filtered_list_command(github, github_repo, index_config, only_mine=False, base_ref=None, head_ref=None, author=None, stale_days=None,
+        output_format='table', limit=None):
+    from tabulate import tabulate
+    from . import index
 
-    # This undo stack is used when we want to back out of changes
-    undo_stack = []
-    class UndoAction(object):
-        def __init__(self, action, failure_is_fatal=False):
-            self.action = action
-            self.failure_is_fatal = failure_is_fatal
+    # Filters are answered from the local index, which only fetches what changed since it was last synced
+    logger.phase('index sync')
+    pull_index = index.PullIndex(index.default_index_path())
+    try:
+        pull_index.sync(github_repo, index_config.ttl_seconds)
+        if only_mine:
+            author = github.get_user().login
+        logger.phase('query')
+        pulls = pull_index.open_pulls(github_repo.full_name, base_ref, head_ref, author, stale_days, limit)
+    finally:
+        pull_index.close()
+
+    logger.phase('render')
+    if output_format != 'table':
+        _write_rows(output_format, FILTERED_LIST_COLUMNS, [pulls])
+        return
+
+    pulls_table = [[
+        pull['number'],
+        pull['title'][:60],
+        pull['head_ref'],
+        pull['base_ref'],
+        pull['author'],
+        pull['updated_at'][:10],
+    ] for pull in pulls]
+    if any(pulls_table):
+        print('\n' + tabulate(pulls_table, ['#', 'Title', 'Branch', 'Base', 'Author', 'Updated']))
+    else:
+        print('No pull requests found')
+
+
+def _check_pull(git_repo, fetcher, repo_full_name, local_branches, pull):
+    # Rebases the pull request onto its base in memory to see how it would go, nothing is checked out or pushed. A
+    # pull request that can't be checked gets an error status, the other checks carry on.
+    try:
+        head_commit = git_repo.git.rev_parse(fetcher.pull_ref(pull['number']))
+        base_commit = git_repo.git.rev_parse(fetcher.tracking_ref(pull['base_ref']))
+        num_behind = int(git_repo.git.rev_list('--count', f'{head_commit}..{base_commit}'))
+        num_unpushed = 0
+        # Pull requests from forks can share a branch name with a local branch that has nothing to do with them
+        if pull['head_repo'] == repo_full_name and pull['head_ref'] in local_branches:
+            num_unpushed = int(git_repo.git.rev_list('--count', f'{head_commit}..refs/heads/{pull["head_ref"]}'))
+
+        details = []
+        status = 'clean'
+        try:
+            plumbing.rebase(git_repo, base_commit, head_commit)
+        except plumbing.MergeConflictError as conflict_error:
+            status = 'conflicts'
+            details.append(', '.join(conflict_error.conflicted_files))
+    except Exception as ex:
+        return {'behind': '', 'status': 'error', 'details': ' '.join(str(ex).split())}
+    if num_unpushed > 0:
+        status = 'diverged' if status == 'clean' else status
+        details.append(f'local branch has {num_unpushed} unpushed commits')
+    return {'behind': num_behind, 'status': status, 'details': '; '.join(details)}
+
+
+def check_command(github, git_repo, github_repo, pull_numbers=None):
+    from concurrent.futures import ThreadPoolExecutor
+    from github import GithubException
+    from tabulate import tabulate
+
+    logger.phase('query')
+    if pull_numbers:
+        pulls = []
+        for pull_number in pull_numbers:
+            try:
+                pull = github_repo.get_pull(pull_number)
+            except Exception as ex:
+                log.error(f'Could not find pull request with number {pull_number}\n    {ex})')
+                exit(1)
+            if pull.state == 'closed':
+                log.error(f'Pull request #{pull_number} is closed')
+                exit(1)
+            pulls.append(_rest_pull_row(pull))
+    else:
+        try:
+            pulls = [row for page in graphql.iter_open_pull_pages(github_repo) for row in page]
+        except (GithubException, graphql.GraphQLError) as ex:
+            log.debug(f'Could not list pull requests through GraphQL, falling back to the REST api: {ex}')
+            pulls = _rest_open_pull_rows(github, github_repo)
+    if not any(pulls):
+        print('No pull requests found')
+        return
 
-    # Find the pull request
-    pull = None
+    # Fetch every pull request head and base at once, into remote tracking refs only
+    logger.phase('fetch')
+    log.info(f'Fetching {len(pulls)} pull requests')
+    fetcher = fetch.RemoteFetcher(git_repo)
+    fetcher.fetch_for_rebase([(pull['base_ref'], None, pull['number']) for pull in pulls])
+
+    # Each check runs a chain of git processes, so checks run side by side on every core
+    logger.phase('check')
+    log.info(f'Checking {len(pulls)} pull requests')
+    local_branches = {head.name for head in git_repo.heads}
+    try:
+        with ThreadPoolExecutor(max_workers=CHECK_WORKERS) as executor:
+            results = list(executor.map(lambda pull: _check_pull(git_repo, fetcher, github_repo.full_name, local_branches, pull), pulls))
+    finally:
+        fetcher.delete_pull_refs()
+
+    logger.phase('render')
+    status_colors = {'clean': colorama.Fore.GREEN, 'conflicts': colorama.Fore.RED, 'diverged': colorama.Fore.YELLOW, 'error': colorama.Fore.MAGENTA}
+    pulls_table = [[
+        pull['number'],
+        pull['title'][:60],
+        pull['head_ref'],
+        pull['base_ref'],
+        result['behind'],
+        f'{status_colors[result["status"]]}{result["status"]}{colorama.Style.RESET_ALL}',
+        result['details'],
+    ] for pull, result in zip(pulls, results)]
+    print('\n' + tabulate(pulls_table, ['#', 'Title', 'Branch', 'Base', 'Behind', 'Status', 'Details']))
+
+
+# This undo stack entry is used when we want to back out of changes
+class UndoAction(object):
+    def __init__(self, action, failure_is_fatal=False):
+        self.action = action
+        self.failure_is_fatal = failure_is_fatal
+
+
+def _revert_back_to_original_state(undo_stack):
+    # Undo stacks are used when we want to back out of changes, the last action is undone first
+    while len(undo_stack) > 0:
+        action = undo_stack.pop()
+        try:
+            action.action()
+        except Exception as ex:
+            if action.failure_is_fatal:
+                log.fatal(f'An unexpected error occurred: {ex}')
+                break
+            else:
+                log.error(f'An unexpected error occurred: {ex}')
+
+
+def _log_git_command_error(command_error):
+    command = command_error._cmdline
+    output = command_error.stdout[12:-1] if len(command_error.stdout) > 0 else ''
+    output = output.replace('\n', '\n> ')
+    log.error(f'An unexpected git error occurred:\n> {command}\n> {output}')
+
+
+def _wait_for_mergeability(pull):
+    # Github computes mergeability in the background after a push, `mergeable` is None until it's done
+    delay = MERGEABILITY_POLL_INITIAL_DELAY
+    deadline = time.monotonic() + MERGEABILITY_POLL_TIMEOUT
+    while (pull.mergeable is None or pull.rebaseable is None) and time.monotonic() < deadline:
+        log.debug(f'Waiting for Github to check whether Pull Request #{pull.number} is mergeable')
+        time.sleep(delay)
+        delay = min(delay * 2, MERGEABILITY_POLL_MAX_DELAY)
+        pull.update()
+
+
+def _is_branch_in_rebaseable_state(git_repo, fetcher, branch):
+    # Are we tracking the branch locally?
+    if branch not in git_repo.heads:
+        return True
+
+    # Branch is being tracked locally, check if we've diverged
+    base_commits_diff = git_repo.git.rev_list('--left-right', '--count', f'{branch}...{fetcher.tracking_ref(branch)}')
+    num_commits_ahead, _ = base_commits_diff.split('\t')
+    has_diverged = int(num_commits_ahead) > 0
+    return not has_diverged
+
+
+def _checkout_branch(git_repo, fetcher, branch):
+    # Single branch clones (shallow clones are by default) don't map other branches to tracking refs, so `git checkout`
+    # can't create the local branch there. Create it from what we fetched instead.
+    if branch in git_repo.heads:
+        git_repo.git.checkout(branch)
+    else:
+        git_repo.git.checkout('-b', branch, fetcher.tracking_ref(branch))
+
+
+def _find_open_pull(github_repo, pull_number):
+    # Returns the pull request, or None and the reason it can't be merged
     try:
         pull = github_repo.get_pull(pull_number)
     except Exception as ex:
-        log.error(f'Could not find pull request with number {pull_number}\n    {ex})')
+        return None, f'Could not find pull request with number {pull_number} ({ex})'
+    if pull.merged:
+        return None, 'This pull request has already been merged'
+    if pull.state == 'closed':
+        return None, 'This pull request is closed'
+    return pull, None
+
+
+def _fetch_for_merge(git_repo, base_ref, pulls, check_mergeability):
+    # Fetch so we're operating on the latest data, only the branches the pull requests touch. The fetch runs while
+    # `check_mergeability(pulls)` checks them through the api, so we only wait for the slowest of the two. Returns the
+    # fetcher and the pull requests check_mergeability kept.
+    log.info('Fetching')
+    fetcher = fetch.RemoteFetcher(git_repo)
+    with tasks.BackgroundTasks(max_workers=1) as fetch_task:
+        fetch_task.submit('Fetching', fetcher.fetch_for_rebase, [(base_ref, pull.head.ref, pull.number) for pull in pulls])
+        pulls = check_mergeability(pulls)
+        logger.phase('wait for fetch')
+    if any(fetch_task.failures):
         exit(1)
+    # The pull request heads were only needed to find where the branches forked, the merge uses the branches
+    fetcher.delete_pull_refs()
 
-    # Has it already been merged?
-    if pull.merged:
-        log.error("This pull request has already been merged.")
+    if not any(pulls):
+        log.error('None of the pull requests can be merged')
         exit(1)
 
-    # Is the pr closed?
-    if pull.state == 'closed':
-        log.error("This pull request is closed")
+    # Has the base branch diverged from remote?
+    if not _is_branch_in_rebaseable_state(git_repo, fetcher, base_ref):
+        log.error(f'The local base branch `{base_ref}` has diverged from remote. Update the branch before continuing')
         exit(1)
+    return fetcher, pulls
 
-    # Is this pr mergeable?
-    if not pull.mergeable or not pull.rebaseable:
-        log.error("""This pull request is not mergeable. This could be due to any of the following:
-  - The pull request merge is blocked by validation rules in this repo
-  - The pull request has merge conflicts""")
 
-        # Ask to if user wants to proceed anyway
-        confirm_continue_answer = input(f"Do you want to proceed anyway? (y/n) ") or "n"
-        if confirm_continue_answer.lower() != 'y':
-            exit(1)
+def _stash_local_changes(git_repo, undo_stack):
+    # Stashes local changes if needed, and remembers the branch the user was on so that we can go back after completion.
+    # Returns that branch and the undo action that checks it out again.
+    if git_repo.is_dirty(untracked_files=True):
+        log.info('Stashing local changes')
+        git_repo.git.stash('push', '--include-untracked')
+
+        def reapply_stash():
+            log.info(f'Re-applying stashed changes')
+            git_repo.git.stash('pop')
+        undo_stack.append(UndoAction(reapply_stash))
+
+    orig_branch = git_repo.active_branch
+    def go_back_to_original_branch():
+        log.info(f'Checking out original branch {orig_branch}')
+        git_repo.git.checkout(orig_branch)
+    checkout_original_branch = UndoAction(go_back_to_original_branch)
+    undo_stack.append(checkout_original_branch)
+    return orig_branch, checkout_original_branch
+
+
+def _check_out_pull_branch(git_repo, fetcher, pull, undo_stack):
+    # Checks out the pr branch, brings it up to date with what we just fetched and creates a backup branch before it's
+    # rebased. Returns the undo action that resets the branch to the backup.
+    log.info(f'Checking out {pull.head.ref}')
+    _checkout_branch(git_repo, fetcher, pull.head.ref)
+    log.info(f'Updating {pull.head.ref}')
+    git_repo.git.rebase(fetcher.tracking_ref(pull.head.ref))
+
+    backup_branch_timestamp = datetime.now().strftime('%H-%M-%S')
+    backup_branch_name = f'backup/{pull.head.ref}-{backup_branch_timestamp}'
+    log.info(f'Creating a backup branch before rebasing: {backup_branch_name}')
+    git_repo.create_head(backup_branch_name)
+    def delete_backup_branch():
+        log.info(f'Deleting the local backup branch {backup_branch_name}')
+        git_repo.git.branch('-D', backup_branch_name)
+    undo_stack.append(UndoAction(delete_backup_branch))
+
+    # Nothing has been pushed yet, so undoing the rebase only needs to reset the local branch
+    def undo_rebase():
+        log.info(f'Undoing rebase')
+        log.info(f'Reverting {pull.head.ref} back to original state at {backup_branch_name}')
+        try:
+            git_repo.git.rebase('--abort')
+        except Exception:
+            pass
+        git_repo.git.reset('--hard')
+        git_repo.git.checkout(pull.head.ref)
+        git_repo.git.reset('--hard', backup_branch_name)
+    undo_rebase_action = UndoAction(undo_rebase, failure_is_fatal=True)
+    undo_stack.append(undo_rebase_action)
+    return undo_rebase_action
+
+
+def _undo_merges_action(git_repo, fetcher, base_ref):
+    # Resets the local base branch to the remote one, dropping the merges made on it
+    def undo_merges():
+        log.info(f'Undoing merges')
+        try:
+            git_repo.git.merge('--abort')
+        except Exception:
+            pass
+        git_repo.git.checkout(base_ref)
+        git_repo.git.reset('--hard', fetcher.tracking_ref(base_ref))
+    return UndoAction(undo_merges, failure_is_fatal=True)
+
 
-    # Utility methods
-    def is_branch_in_rebaseable_state(branch):
-        # Are we tracking the branch locally?
-        if branch not in git_repo.refs:
-            return True
-
-        # Branch is being tracked locally, check if we've diverged
-        base_commits_diff = git_repo.git.rev_list('--left-right', '--count', f'{branch}...{branch}@{{u}}')
-        num_commits_ahead, _ = base_commits_diff.split('\t')
-        has_diverged = int(num_commits_ahead) > 0
-        return not has_diverged
-
-    def revert_back_to_original_state():
-        while len(undo_stack) > 0:
-            action = undo_stack.pop()
+def _format_merge_msg(commit_msg_format, pull):
+    return commit_msg_format.format(
+        TITLE=pull.title,
+        NUMBER=pull.number,
+        AUTHOR_USERNAME=pull.user.login,
+        AUTHOR_NAME=pull.user.name
+    )
+
+
+def _format_squash_msg(commit_msg_format, pull, commit_stats):
+    # The squash commit has a single author, the others are credited in trailers like Github does
+    squash_msg = _format_merge_msg(commit_msg_format, pull)
+    co_authored_by = [f'Co-authored-by: {author}' for author in commit_stats.other_authors]
+    return squash_msg + '\n\n' + '\n'.join(co_authored_by) if any(co_authored_by) else squash_msg
+
+
+def _log_merge_preview(git_repo, tip, upstream, num_extra_lines_to_highlight):
+    # Output preview of the base branch (up to tip) with the new commits that aren't in upstream highlighted
+    num_commits_to_push = int(git_repo.git.rev_list('--count', f'{tip}...{upstream}'))
+    branch_format_decorated = f'{colorama.Fore.CYAN}{colorama.Back.BLACK}%d{colorama.Style.RESET_ALL}'
+    preview_history = git_repo.git.log(f'--pretty=format:%s{branch_format_decorated}', '--graph', f'-{num_commits_to_push+3}', tip).split('\n')
+    num_lines_to_highlight = min(num_commits_to_push + num_extra_lines_to_highlight, len(preview_history))
+    new_commit_color_style = f'{colorama.Fore.WHITE}{colorama.Back.YELLOW}'
+    for i in range(num_lines_to_highlight):
+        preview_history[i] = re.sub(r'^\*(.*?)', f'{new_commit_color_style}*{colorama.Style.RESET_ALL}' + r'\1', preview_history[i], 1)
+        preview_history[i] = re.sub(r'^\|(.*?)', f'{new_commit_color_style}|{colorama.Style.RESET_ALL}' + r'\1', preview_history[i], 1)
+    log.info(f'Confirm merge:\n  ' + '\n  '.join(preview_history))
+
+
+def _retarget_upstream_pulls(background_tasks, github_repo, pulls):
+    # If there are any pull requests that have a merged PR's branch as their base, we should change their
+    # base to the merged PR's base, or else GitHub may close those PRs instead.
+    # This only talks to the Github api, so it runs in the background while we clean up.
+    def retarget_upstream_pull(upstream_pull, base_ref):
+        upstream_pull.edit(base=base_ref)
+        log.info(f'  Retargeted: {upstream_pull.title} (#{upstream_pull.number}) onto {base_ref}')
+
+    def retarget_upstream_pulls(pull):
+        upstream_pulls = list(github_repo.get_pulls(base=pull.head.ref))
+        if not any(upstream_pulls):
+            log.info(f'  No pull requests found with base branch {pull.head.ref}')
+        for upstream_pull in upstream_pulls:
+            background_tasks.submit(f'Retargeting #{upstream_pull.number} onto {pull.base.ref}', retarget_upstream_pull, upstream_pull, pull.base.ref)
+
+    for pull in pulls:
+        log.info(f'Retargeting any pull requests with base branch {pull.head.ref}...')
+        background_tasks.submit(f'Finding pull requests with base branch {pull.head.ref}', retarget_upstream_pulls, pull)
+
+
+def _push_with_lease(git_repo, updates):
+    # Pushes (branch, expected commit, new commit) updates in a single atomic push, the remote takes all of them or none.
+    # A branch is only updated if the remote still has it at the expected commit, so nothing pushed since is overwritten.
+    lease_args = [f'--force-with-lease=refs/heads/{branch}:{expected_commit}' for branch, expected_commit, _ in updates]
+    refspecs = [f'{new_commit}:refs/heads/{branch}' for branch, _, new_commit in updates]
+    git_repo.git.push('origin', '--atomic', '--no-verify', *lease_args, *refspecs)
+
+
+def _parse_author(author):
+    # 'Name <email>' as printed by `git log`, into a (name, email, date) author for plumbing.commit_tree. None, so the
+    # commit is made as the current user, when there is no author, e.g. the pull request has no commits of its own.
+    match = re.match(r'(.*) <(.*)>', author or '')
+    if not match:
+        return None
+    return (match.group(1), match.group(2), None)
+
+
+def _author_args(author):
+    # `git commit` arguments for the squash author, the current user when there is none
+    return ['--author', author] if author else []
+
+
+def _update_local_branches_after_merge(git_repo, fetcher, base_ref, head_refs):
+    # The merge happened without a checkout, bring the local branches in line with the remote now. If the user is on
+    # one of them, this only touches the files that changed.
+    active_branch = None if git_repo.head.is_detached else git_repo.active_branch.name
+    if active_branch in head_refs:
+        log.info(f'Checking out {base_ref}')
+        git_repo.git.checkout('-B', base_ref, fetcher.tracking_ref(base_ref))
+    elif active_branch == base_ref:
+        log.info(f'Updating {base_ref}')
+        git_repo.git.merge('--ff-only', fetcher.tracking_ref(base_ref))
+    elif base_ref in git_repo.heads:
+        log.info(f'Updating {base_ref}')
+        fetcher.update_local_branch(base_ref)
+
+    local_head_refs = [head_ref for head_ref in head_refs if head_ref in git_repo.heads]
+    if any(local_head_refs):
+        git_repo.git.branch('-D', *local_head_refs)
+
+
+def _publish_merge(git_repo, github_repo, fetcher, undo_stack, base_ref, pulls, updates, upstream_pulls=None, squash_msg=None):
+    # Pushes merges that were made locally or in memory, then retargets the pull requests based on the merged branches
+    # and deletes those. `updates` are the (branch, expected commit, new commit) of the push. With a squash message, the
+    # single pull request is squashed through the api once its rebased branch is pushed, otherwise Github would mark it
+    # as closed instead of merged. Returns whether the merge was published.
+    import git
+
+    with tasks.BackgroundTasks() as post_merge_tasks:
+        logger.phase('push')
+        if squash_msg is not None:
+            pull = pulls[0]
+            log.info(f'Force-pushing {pull.head.ref}')
+            _push_with_lease(git_repo, updates)
+            def undo_head_push():
+                log.info(f'Reverting {pull.head.ref} back to original state')
+                log.info(f'Force-pushing {pull.head.ref}')
+                _push_with_lease(git_repo, [(branch, new_commit, expected_commit) for branch, expected_commit, new_commit in updates])
+            undo_head_push_action = UndoAction(undo_head_push, failure_is_fatal=True)
+            undo_stack.append(undo_head_push_action)
+
+            log.info(f'{colorama.Fore.CYAN}Squashing...')
+            # The api takes the first line as the title, the trailers go in the message
+            squash_title, _, squash_body = squash_msg.partition('\n')
+            pull.merge(squash_body.strip(), squash_title, merge_method='squash')
+            undo_stack.remove(undo_head_push_action)
+        else:
+            # Push the rebased pr branches and the base together. If any of them has been updated since we started,
+            # the push is rejected as a whole and nothing changes on the remote.
+            log.info(f'{colorama.Fore.CYAN}Pushing ' + ', '.join(branch for branch, _, _ in updates))
             try:
-                action.action()
-            except Exception as ex:
-                if action.failure_is_fatal:
-                    log.fatal(f'An unexpected error occurred: {ex}')
-                    break
-                else:
-                    log.error(f'An unexpected error occurred: {ex}')
+                _push_with_lease(git_repo, updates)
+            except git.CommandError as command_error:
+                _log_git_command_error(command_error)
+                log.error(f'The base branch `{base_ref}` or a pull request branch has been updated since we started. Try running this script again')
+                return False
 
-    # Fetch so we're operating on the latest data
-    log.info('Fetching')
-    git_repo.remotes.origin.fetch()
+        for pull in pulls:
+            log.info(f'{colorama.Fore.GREEN}Successfully merged Pull Request #{pull.number}')
+        # Only retarget once merged, a rejected merge would leave them with the pr branches' commits
+        _retarget_upstream_pulls(post_merge_tasks, github_repo, upstream_pulls or pulls)
+        if squash_msg is not None:
+            # Github made the squash commit, so the base has to be fetched
+            fetcher.fetch([base_ref], refresh=True)
+        else:
+            fetcher.mark_pushed(base_ref)
 
-    # Has the base branch diverged from remote?
-    if not is_branch_in_rebaseable_state(pull.base.ref):
-        log.error(f'The local base branch `{pull.base.ref}` has diverged from remote. Update the branch before continuing')
+        logger.phase('cleanup')
+        # Deleting the pr branches closes pull requests that still have them as base, so wait until they're retargeted
+        head_refs = [pull.head.ref for pull in pulls]
+        branches = 'branch' if len(head_refs) == 1 else 'branches'
+        if post_merge_tasks.wait():
+            log.info(f'Deleting the pull request {branches} {", ".join(head_refs)}')
+            try: # trycatch here because GitPython seems to throw an error here, even if it succeeds
+                git_repo.git.push('origin', '--delete', '--no-verify', *head_refs)
+            except:
+                pass
+        else:
+            log.warning(f'Not deleting the pull request {branches} {", ".join(head_refs)} because not all pull requests based on them were retargeted')
+    return True
+
+
+def _merge_without_checkout(merge_with_squash, git_repo, github_repo, pull, merge_config, fetcher, unattended=False):
+    import git
+
+    undo_stack = []
+
+    ## Do Linear Merge without touching the index or worktree
+    #  1. Rebase the pull request commits onto the remote base in memory
+    #  2. Create the merge (or squash) commit on top of the remote base in memory
+    #  3. Ask user for confirmation
+    #  4. Change base branch of any PRs that have this PR as base
+    #  5. Push the rebased pull request branch and the base branch together
+    #  6. Delete pull request branch (local and remote)
+    #  7. Bring the local base branch up to date (unless unattended)
+    try:
+        logger.phase('rebase')
+        base_commit = git_repo.git.rev_parse(fetcher.tracking_ref(pull.base.ref))
+        head_commit = git_repo.git.rev_parse(fetcher.tracking_ref(pull.head.ref))
+
+        log.info(f'{colorama.Fore.CYAN}Rebasing {pull.head.ref} onto {pull.base.ref} (without checkout)')
+        rebased_head_commit = plumbing.rebase(git_repo, base_commit, head_commit)
+        rebased_head_tree = git_repo.git.rev_parse(f'{rebased_head_commit}^{{tree}}')
+
+        commit_stats = stats.branch_stats(git_repo, base_commit, rebased_head_commit)
+        if commit_stats.num_commits == 1 and merge_config.always_squash_single_commit_pulls:
+            merge_with_squash = True
+
+        logger.phase('merge')
+        commit_msg_format = merge_config.squash_msg_format if merge_with_squash else merge_config.merge_msg_format
+        merge_msg = _format_squash_msg(commit_msg_format, pull, commit_stats) if merge_with_squash else _format_merge_msg(commit_msg_format, pull)
+        if merge_with_squash:
+            log.info(f'{colorama.Fore.CYAN}Squashing {pull.head.ref} onto {pull.base.ref} (without checkout)')
+            merge_commit = plumbing.commit_tree(git_repo, rebased_head_tree, [base_commit], merge_msg, _parse_author(commit_stats.main_author))
+        else:
+            log.info(f'{colorama.Fore.CYAN}Merging {pull.head.ref} onto {pull.base.ref} (without checkout)')
+            merge_commit = plumbing.commit_tree(git_repo, rebased_head_tree, [base_commit, rebased_head_commit], merge_msg)
+
+        logger.phase('preview')
+        # Output preview of the merged base branch with new commits highlighted
+        _log_merge_preview(git_repo, merge_commit, base_commit, 0 if merge_with_squash else 2)
+
+        logger.phase('confirm')
+        # Ask for permission to push
+        confirm_merge_answer = 'y' if unattended else input(f"Does this look correct? (y/n) ") or "n"
+
+        # Push the merge, for squashes only the rebased pr branch is pushed
+        if confirm_merge_answer.lower() == 'y':
+            updates = [(pull.head.ref, head_commit, rebased_head_commit)]
+            if not merge_with_squash:
+                updates.append((pull.base.ref, base_commit, merge_commit))
+            merged = _publish_merge(git_repo, github_repo, fetcher, undo_stack, pull.base.ref, [pull], updates,
+                squash_msg=merge_msg if merge_with_squash else None)
+            # Unattended merges don't know what the user is doing with the local branches, if anything
+            if merged and not unattended:
+                _update_local_branches_after_merge(git_repo, fetcher, pull.base.ref, [pull.head.ref])
+
+    except plumbing.MergeConflictError as conflict_error:
+        log.error(f'Could not rebase {pull.head.ref} onto {pull.base.ref}. {conflict_error}')
+
+    except git.CommandError as command_error:
+        _log_git_command_error(command_error)
+
+    except Exception as ex:
+        log.error(f'An unexpected error occurred: {ex}')
+
+    finally:
+        logger.phase('revert')
+        # Done! Apply all necessary actions to go back to the starting state
+        _revert_back_to_original_state(undo_stack)
+
+
+def merge_command(merge_with_squash, git_repo, github_repo, pull_number, merge_config, unattended=False):
+    import git
+
+    log.info(f'{colorama.Fore.CYAN}Preparing to merge Pull Request #{pull_number}')
+
+    logger.phase('validate')
+    pull, reason = _find_open_pull(github_repo, pull_number)
+    if pull is None:
+        log.error(reason)
         exit(1)
 
+    def check_mergeability(pulls):
+        _wait_for_mergeability(pull)
+        if not pull.mergeable or not pull.rebaseable:
+            log.error("""This pull request is not mergeable. This could be due to any of the following:
+  - The pull request merge is blocked by validation rules in this repo
+  - The pull request has merge conflicts
+  - Github has not finished checking whether the pull request is mergeable""")
+
+            # Ask to if user wants to proceed anyway
+            confirm_continue_answer = 'n' if unattended else input(f"Do you want to proceed anyway? (y/n) ") or "n"
+            if confirm_continue_answer.lower() != 'y':
+                exit(1)
+        return pulls
+    fetcher, _ = _fetch_for_merge(git_repo, pull.base.ref, [pull], check_mergeability)
+
     # Has the pr branch diverged from remote?
-    if not is_branch_in_rebaseable_state(pull.head.ref):
+    if not _is_branch_in_rebaseable_state(git_repo, fetcher, pull.head.ref):
         log.error(f'The local branch `{pull.head.ref}` has diverged from remote. Update the branch before continuing')
         exit(1)
 
+    if merge_config.no_checkout:
+        _merge_without_checkout(merge_with_squash, git_repo, github_repo, pull, merge_config, fetcher, unattended)
+        return
+
+    undo_stack = []
+
     ## Do Linear Merge
     #  1. Stash local changes if necessary
     #  2. Fetch from origin
     #  3. Checkout the pull request branch & update it
     #  4. Create a backup branch before rebasing
-    #  5. Rebase the pull request branch & force-push to origin
+    #  5. Rebase the pull request branch
     #  6. Checkout pull request base branch
     #  7. Merge pull request branch into base
     #  8. Ask user for confirmation
     #  9. Change base branch of any PRs that have this PR as base
-    # 10. Push base branch
+    # 10. Push the rebased pull request branch and the base branch together
     # 11. Delete pull request branch (local and remote)
     # 12. Delete backup branch
     # 13. Checkout the branch the user was originally on (if user wasn't on the pr branch)
     # 14. Re-apply local stash if necessary
     try:
-        # Stash local changes if needed
-        if git_repo.is_dirty(untracked_files=True):
-            log.info('Stashing local changes')
-            git_repo.git.stash('push', '--include-untracked')
-
-            def reapply_stash():
-                log.info(f'Re-applying stashed changes')
-                git_repo.git.stash('pop')
-            undo_stack.append(UndoAction(reapply_stash))
-
-        # Preserve the current branch the user was on, so that we can go back after completion
-        orig_branch = git_repo.active_branch
-        def go_back_to_original_branch():
-            log.info(f'Checking out original branch {orig_branch}')
-            git_repo.git.checkout(orig_branch)
-        checkout_original_branch = UndoAction(go_back_to_original_branch)
-        undo_stack.append(checkout_original_branch)
-
-        # Checkout the pr branch and bring it up to date if necessary
-        log.info(f'Checking out {pull.head.ref}')
-        git_repo.git.checkout(pull.head.ref)
-        log.info(f'Updating {pull.head.ref}')
-        git_repo.git.pull('--rebase')
-
-        # Create a backup branch before rebasing
-        backup_branch_timestamp = datetime.now().strftime('%H-%M-%S')
-        backup_branch_name = f'backup/{pull.head.ref}-{backup_branch_timestamp}'
-        log.info(f'Creating a backup branch before rebasing: {backup_branch_name}')
-        git_repo.create_head(backup_branch_name)
-        def delete_backup_branch():
-            log.info(f'Deleting the local backup branch {backup_branch_name}')
-            git_repo.git.branch('-D', backup_branch_name)
-        undo_stack.append(UndoAction(delete_backup_branch))
+        logger.phase('rebase')
+        orig_branch, checkout_original_branch = _stash_local_changes(git_repo, undo_stack)
+        undo_rebase_action = _check_out_pull_branch(git_repo, fetcher, pull, undo_stack)
 
         # Rebase the pr branch on top of the base (remote)
-        def undo_rebase():
-            log.info(f'Undoing rebase')
-            log.info(f'Reverting {pull.head.ref} back to original state at {backup_branch_name}')
-            try:
-                git_repo.git.rebase('--abort')
-            except Exception:
-                pass
-            git_repo.git.reset('--hard')
-            git_repo.git.checkout(pull.head.ref)
-            git_repo.git.reset('--hard', backup_branch_name)
-            log.info(f'Force-pushing {pull.head.ref}')
-            git_repo.git.push('-f', '--no-verify')
-        undo_rebase_action = UndoAction(undo_rebase, failure_is_fatal=True)
-        undo_stack.append(undo_rebase_action)
-
         log.info(f'Updating {pull.base.ref}')
-        git_repo.git.fetch('origin', f'{pull.base.ref}:{pull.base.ref}')
+        fetcher.fetch([pull.base.ref])
+        fetcher.update_local_branch(pull.base.ref)
         log.info(f'{colorama.Fore.CYAN}Rebasing {pull.head.ref} onto {pull.base.ref}')
         git_repo.git.rebase(pull.base.ref)
-        log.info(f'Force-pushing {pull.head.ref}')
-        git_repo.git.push('origin', '-f', '--no-verify', pull.head.ref)
+        # Nothing is pushed until the merge is confirmed, then everything is pushed at once
+        head_commit = git_repo.git.rev_parse(fetcher.tracking_ref(pull.head.ref))
+        rebased_head_commit = git_repo.head.commit.hexsha
 
         # Checkout the base branch and bring it up to date if necessary
         log.info(f'Checking out {pull.base.ref}')
-        git_repo.git.checkout(pull.base.ref)
-        git_repo.git.branch(f'--set-upstream-to=origin/{pull.base.ref}', pull.base.ref) # Fixes an issue where checkout didn't track the upstream
+        _checkout_branch(git_repo, fetcher, pull.base.ref)
         log.info(f'Updating {pull.base.ref}')
-        git_repo.git.pull('--rebase')
+        git_repo.git.rebase(fetcher.tracking_ref(pull.base.ref))
+        base_commit = git_repo.head.commit.hexsha
 
+        logger.phase('merge')
         # Merge pr branch into base
-        def undo_pr_merge():
-            log.info(f'Undoing merge')
-            try:
-                git_repo.git.merge('--abort')
-            except Exception:
-                pass
-            git_repo.git.checkout(pull.base.ref)
-            git_repo.git.reset('--hard', f'{pull.base.ref}@{{u}}')
-        undo_pr_merge_action = UndoAction(undo_pr_merge, failure_is_fatal=True)
+        undo_pr_merge_action = _undo_merges_action(git_repo, fetcher, pull.base.ref)
         undo_stack.append(undo_pr_merge_action)
 
-        num_commits_on_branch = len(list(git_repo.iter_commits(f'{pull.base.ref}...{pull.head.ref}@{{u}}')))
-        if num_commits_on_branch == 1 and merge_config.always_squash_single_commit_pulls:
+        commit_stats = stats.branch_stats(git_repo, pull.base.ref, rebased_head_commit)
+        if commit_stats.num_commits == 1 and merge_config.always_squash_single_commit_pulls:
             merge_with_squash = True
 
         commit_msg_format = merge_config.squash_msg_format if merge_with_squash else merge_config.merge_msg_format
-        merge_msg = commit_msg_format.format(
-            TITLE=pull.title,
-            NUMBER=pull.number,
-            AUTHOR_USERNAME=pull.user.login,
-            AUTHOR_NAME=pull.user.name
-        )
+        merge_msg = _format_squash_msg(commit_msg_format, pull, commit_stats) if merge_with_squash else _format_merge_msg(commit_msg_format, pull)
         if merge_with_squash:
-            # Find author to attribute the commit to (select author with most commits on branch)
-            commit_log = git_repo.git.log(pull.head.sha, '-n', num_commits_on_branch)
-            commit_authors = sorted(list(re.findall(r'Author: (.*?)\n', commit_log)))
-            commit_authors_count = {k:len(list(g)) for k, g in groupby(commit_authors)}
-            main_author = max(commit_authors_count, key=commit_authors_count.get)
-
-            # Do the squash
+            # Do the squash, attributed to the author with most commits on the branch
             log.info(f'{colorama.Fore.CYAN}Squashing {pull.head.ref} onto {pull.base.ref}')
             git_repo.git.merge('--squash', pull.head.sha)
-            git_repo.git.commit('--author', main_author, '-m', merge_msg)
+            git_repo.git.commit(*_author_args(commit_stats.main_author), '-m', merge_msg)
         else:
             # Regular merge preserving all commits from the original branch
             log.info(f'{colorama.Fore.CYAN}Merging {pull.head.ref} onto {pull.base.ref}')
             git_repo.git.merge(pull.head.ref, '--no-ff', '-m', merge_msg)
 
+        logger.phase('preview')
         # Output preview of local base branch with new commits highlighted
-        num_commits_to_push = len(list(git_repo.iter_commits(f'{pull.base.ref}...{pull.base.ref}@{{u}}')))
-        branch_format_decorated = f'{colorama.Fore.CYAN}{colorama.Back.BLACK}%d{colorama.Style.RESET_ALL}'
-        preview_history = git_repo.git.log(f'--pretty=format:%s{branch_format_decorated}', '--graph', f'-{num_commits_to_push+3}').split('\n')
-        num_lines_to_highlight = num_commits_to_push + (0 if merge_with_squash else 2)
-        new_commit_color_style = f'{colorama.Fore.WHITE}{colorama.Back.YELLOW}'
-        for i in range(num_lines_to_highlight):
-            preview_history[i] = re.sub(r'^\*(.*?)', f'{new_commit_color_style}*{colorama.Style.RESET_ALL}' + r'\1', preview_history[i], 1)
-            preview_history[i] = re.sub(r'^\|(.*?)', f'{new_commit_color_style}|{colorama.Style.RESET_ALL}' + r'\1', preview_history[i], 1)
-        log.info(f'Confirm merge:\n  ' + '\n  '.join(preview_history))
+        _log_merge_preview(git_repo, pull.base.ref, fetcher.tracking_ref(pull.base.ref), 0 if merge_with_squash else 2)
 
+        logger.phase('confirm')
         # Ask for permission to push
         confirm_merge_answer = input(f"Does this look correct? (y/n) ") or "n"
 
-        # Push the merge
+        # Push the merge, for squashes only the rebased pr branch is pushed
         if confirm_merge_answer.lower() == 'y':
-            merge_succeeded = False
-
-            # If there are any pull requests that have the current PR's branch as their base, we should change their
-            # base to the current PR's base, or else GitHub may close those PRs instead.
-            log.info(f'Retargeting any pull requests with base branch {pull.head.ref}...')
-            upstream_pulls = github_repo.get_pulls(base=pull.head.ref)
-            if upstream_pulls.totalCount > 0:
-                for upstream_pull in upstream_pulls:
-                    log.info(f'  Updating: {upstream_pull.title} (#{upstream_pull.number})')
-                    upstream_pull.edit(base=pull.base.ref)
+            updates = [(pull.head.ref, head_commit, rebased_head_commit)]
+            if not merge_with_squash:
+                updates.append((pull.base.ref, base_commit, git_repo.head.commit.hexsha))
+            if _publish_merge(git_repo, github_repo, fetcher, undo_stack, pull.base.ref, [pull], updates,
+                    squash_msg=merge_msg if merge_with_squash else None):
+                if merge_with_squash:
+                    # Now our local base branch is out of date, reset it to the squash Github made
+                    git_repo.git.reset('--hard', fetcher.tracking_ref(pull.base.ref))
+
+                # Pop some elements
+                undo_stack.remove(undo_rebase_action)
+                undo_stack.remove(undo_pr_merge_action)
+
+                # If user was on the pr branch before running the script, stay on the base branch which we are currently on
+                if orig_branch.name == pull.head.ref:
+                    # No longer need to go back to original branch
+                    undo_stack.remove(checkout_original_branch)
+
+                # Delete local pr branch
+                git_repo.git.branch('-D', pull.head.ref)
+
+    except git.CommandError as command_error:
+        _log_git_command_error(command_error)
+
+    except Exception as ex:
+        log.error(f'An unexpected error occurred: {ex}')
+
+    finally:
+        logger.phase('revert')
+        # Done! Apply all necessary actions to go back to the starting state
+        _revert_back_to_original_state(undo_stack)
+
+
+def _log_skipped_pulls(skipped_pulls):
+    if any(skipped_pulls):
+        log.warning('The following pull requests were skipped:\n' + '\n'.join(f'  #{number}: {reason}' for number, reason in skipped_pulls))
+
+
+def _merge_queue_without_checkout(merge_with_squash, git_repo, github_repo, pulls, merge_config, fetcher, skip_pull, skipped_pulls, stacked=False):
+    import git
+
+    # Stacked pull requests are ordered bottom-up, each one based on the head branch of the previous one
+    base_ref = pulls[0].base.ref
+
+    undo_stack = []
+
+    ## Do Linear Merge Queue without touching the index or worktree
+    #  1. For each pull request, rebase it onto the queue tip in memory and merge it (skip it if either fails)
+    #  2. Ask user for confirmation of all merges at once
+    #  3. For stacks, change the base branch of the stacked PRs to the stack's base
+    #  4. Change base branch of any PRs that have a merged PR as base
+    #  5. Push all pull request branches and the base branch in a single atomic push
+    #  6. Delete merged pull request branches (local and remote)
+    #  7. Bring the local base branch up to date
+    merged_pulls = []
+    try:
+        logger.phase('rebase and merge')
+        base_commit = git_repo.git.rev_parse(fetcher.tracking_ref(base_ref))
+        queue_tip_commit = base_commit
+        num_skipped_before_queue = len(skipped_pulls)
+        previous_head_commit = None
+        for pull in pulls:
+            log.info(f'{colorama.Fore.CYAN}Queueing Pull Request #{pull.number}: {pull.title}')
+
+            # A stacked pull request can't be merged without the one it's stacked on
+            if stacked and len(skipped_pulls) > num_skipped_before_queue:
+                skip_pull(pull.number, f'It is stacked on `{pull.base.ref}`, which was skipped')
+                continue
+
+            # Has the pr branch diverged from remote?
+            if not _is_branch_in_rebaseable_state(git_repo, fetcher, pull.head.ref):
+                skip_pull(pull.number, f'The local branch `{pull.head.ref}` has diverged from remote')
+                continue
+
+            # The commits of the branch a pull request is stacked on were merged already, so only its own are rebased
+            head_commit = git_repo.git.rev_parse(fetcher.tracking_ref(pull.head.ref))
+            upstream_commit = previous_head_commit if stacked else None
+            log.info(f'{colorama.Fore.CYAN}Rebasing {pull.head.ref} onto {base_ref} (without checkout)')
+            try:
+                rebased_head_commit = plumbing.rebase(git_repo, queue_tip_commit, head_commit, upstream_commit)
+            except plumbing.MergeConflictError as conflict_error:
+                skip_pull(pull.number, f'Could not rebase `{pull.head.ref}` onto `{base_ref}`. {conflict_error}')
+                continue
+            previous_head_commit = head_commit
+            rebased_head_tree = git_repo.git.rev_parse(f'{rebased_head_commit}^{{tree}}')
+
+            commit_stats = stats.branch_stats(git_repo, queue_tip_commit, rebased_head_commit)
+            pull_with_squash = merge_with_squash or (commit_stats.num_commits == 1 and merge_config.always_squash_single_commit_pulls)
+
+            commit_msg_format = merge_config.squash_msg_format if pull_with_squash else merge_config.merge_msg_format
+            merge_msg = _format_squash_msg(commit_msg_format, pull, commit_stats) if pull_with_squash else _format_merge_msg(commit_msg_format, pull)
+            if pull_with_squash:
+                # The pr branch is pushed pointing at the squashed commit, so that GitHub marks the pull request as
+                # merged instead of closed once the base is pushed
+                log.info(f'{colorama.Fore.CYAN}Squashing {pull.head.ref} onto {base_ref} (without checkout)')
+                queue_tip_commit = plumbing.commit_tree(git_repo, rebased_head_tree, [queue_tip_commit], merge_msg, _parse_author(commit_stats.main_author))
+                merged_pulls.append((pull, pull_with_squash, queue_tip_commit))
             else:
-                log.info(f'  Done! No pull requests found')
+                log.info(f'{colorama.Fore.CYAN}Merging {pull.head.ref} onto {base_ref} (without checkout)')
+                queue_tip_commit = plumbing.commit_tree(git_repo, rebased_head_tree, [queue_tip_commit, rebased_head_commit], merge_msg)
+                merged_pulls.append((pull, pull_with_squash, rebased_head_commit))
+
+        if not any(merged_pulls):
+            log.error('None of the pull requests could be merged')
+            return
+
+        logger.phase('preview')
+        # Output one combined preview of the merged base branch with new commits highlighted
+        num_regular_merges = len([_ for _, pull_with_squash, _ in merged_pulls if not pull_with_squash])
+        _log_merge_preview(git_repo, queue_tip_commit, base_commit, 2 * num_regular_merges)
+        if any(skipped_pulls):
+            log.warning('Skipped: ' + ', '.join(f'#{number}' for number, _ in skipped_pulls))
+
+        logger.phase('confirm')
+        # Ask for permission to push
+        confirm_merge_answer = input(f"Does this look correct? (y/n) ") or "n"
+
+        # Push the merges
+        if confirm_merge_answer.lower() == 'y':
+            retarget_undo_actions = []
+            if stacked and len(merged_pulls) > 1:
+                # Github only marks a pull request as merged once its head is in its base branch, so the stacked pull
+                # requests target the stack's base before anything is pushed
+                logger.phase('retarget stack')
+                with tasks.BackgroundTasks() as retarget_tasks:
+                    for pull, _, _ in merged_pulls[1:]:
+                        def undo_retarget(pull=pull, original_base_ref=pull.base.ref):
+                            log.info(f'Retargeting #{pull.number} back onto {original_base_ref}')
+                            pull.edit(base=original_base_ref)
+                        retarget_undo_actions.append(UndoAction(undo_retarget))
+                        log.info(f'Retargeting #{pull.number} onto {base_ref}')
+                        retarget_tasks.submit(f'Retargeting #{pull.number} onto {base_ref}', pull.edit, base=base_ref)
+                    undo_stack.extend(retarget_undo_actions)
+                    if not retarget_tasks.wait():
+                        log.error('Could not retarget the stacked pull requests, nothing was merged')
+                        return
+
+            # Push all rebased pr branches and the base together. The pull requests of a stack are based on each other,
+            # only those based on the top one are left to retarget.
+            head_updates = [(pull.head.ref, fetcher.tracking_ref(pull.head.ref), published_head_commit) for pull, _, published_head_commit in merged_pulls]
+            upstream_pulls = [merged_pulls[-1][0]] if stacked else None
+            if _publish_merge(git_repo, github_repo, fetcher, undo_stack, base_ref, [pull for pull, _, _ in merged_pulls],
+                    head_updates + [(base_ref, base_commit, queue_tip_commit)], upstream_pulls):
+                for undo_retarget_action in retarget_undo_actions:
+                    undo_stack.remove(undo_retarget_action)
+                _update_local_branches_after_merge(git_repo, fetcher, base_ref, [pull.head.ref for pull, _, _ in merged_pulls])
+
+    except git.CommandError as command_error:
+        _log_git_command_error(command_error)
+
+    except Exception as ex:
+        log.error(f'An unexpected error occurred: {ex}')
+
+    finally:
+        logger.phase('revert')
+        # Done! Apply all necessary actions to go back to the starting state
+        _revert_back_to_original_state(undo_stack)
+
 
-            # For squashes, use github api to merge because otherwise the PR will be marked as closed instead of merged
-            if merge_with_squash:
-                log.info(f'{colorama.Fore.CYAN}Squashing...')
-                pull.merge('', merge_msg, merge_method='squash')
-                merge_succeeded = True
+def merge_queue_command(merge_with_squash, git_repo, github_repo, pull_numbers, merge_config):
+    import git
 
-                # Now our local base branch is out of date, we need to fetch and reset to the origin branch
-                git_repo.remotes.origin.fetch()
-                git_repo.git.reset('--hard', f'{pull.base.ref}@{{u}}')
+    log.info(f'{colorama.Fore.CYAN}Preparing to merge {len(pull_numbers)} Pull Requests: ' + ', '.join(f'#{n}' for n in pull_numbers))
+
+    undo_stack = []
+
+    logger.phase('validate')
+    # Pull requests that could not be merged are skipped, the rest of the queue keeps going
+    skipped_pulls = []
+    def skip_pull(pull_number, reason):
+        log.error(f'Skipping Pull Request #{pull_number}: {reason}')
+        skipped_pulls.append((pull_number, reason))
+
+    # Find the pull requests, they all need to target the same base branch
+    pulls = []
+    for pull_number in pull_numbers:
+        pull, reason = _find_open_pull(github_repo, pull_number)
+        if pull is None:
+            skip_pull(pull_number, reason)
+        elif any(pulls) and pull.base.ref != pulls[0].base.ref:
+            skip_pull(pull_number, f'Base branch `{pull.base.ref}` differs from the queue base branch `{pulls[0].base.ref}`')
+        else:
+            pulls.append(pull)
 
-            # regular merge
+    if not any(pulls):
+        log.error('None of the pull requests can be merged')
+        exit(1)
+    base_ref = pulls[0].base.ref
+
+    def check_mergeability(pulls):
+        mergeable_pulls = []
+        for pull in pulls:
+            _wait_for_mergeability(pull)
+            if not pull.mergeable or not pull.rebaseable:
+                skip_pull(pull.number, 'This pull request is not mergeable')
             else:
-                log.info(f'{colorama.Fore.CYAN}Pushing merge...')
+                mergeable_pulls.append(pull)
+        return mergeable_pulls
+    fetcher, pulls = _fetch_for_merge(git_repo, base_ref, pulls, check_mergeability)
 
-                # Check that the base branch has not been updated since
-                git_repo.remotes.origin.fetch()
-                base_commits_diff = git_repo.git.rev_list('--left-right', '--count', f'{pull.base.ref}...{pull.base.ref}@{{u}}')
-                _, num_behind = base_commits_diff.split('\t')
+    if merge_config.no_checkout:
+        try:
+            _merge_queue_without_checkout(merge_with_squash, git_repo, github_repo, pulls, merge_config, fetcher, skip_pull, skipped_pulls)
+        finally:
+            _log_skipped_pulls(skipped_pulls)
+        return
 
-                # Can we continue?
-                if int(num_behind) > 0:
-                    log.error(f'The base branch `{pull.base.ref}` has been updated since we started. Try running this script again')
-                else:
-                    # Push
-                    log.info(f'{colorama.Fore.CYAN}Pushing {pull.base.ref}')
-                    git_repo.git.push('origin', '--no-verify', pull.base.ref)
-                    log.info(f'{colorama.Fore.GREEN}Successfully merged Pull Request #{pull.number}')
-                    merge_succeeded = True
-
-            # Cleaup after merge
-            if merge_succeeded:
-                # Delete the remote pr branch
-                log.info(f'Deleting the pull request branch {pull.head.ref}')
-                try: # trycatch here because GitPython seems to throw an error here, even if it succeeds
-                    git_repo.git.push('origin', '--delete', '--no-verify', pull.head.ref)
-                except:
+    ## Do Linear Merge Queue
+    #  1. Stash local changes if necessary
+    #  2. Checkout the base branch & update it
+    #  3. For each pull request, rebase it onto the local base and merge it (skip it if either fails)
+    #  4. Ask user for confirmation of all merges at once
+    #  5. Change base branch of any PRs that have a merged PR as base
+    #  6. Push all pull request branches and the base branch in a single atomic push
+    #  7. Delete merged pull request branches (local and remote)
+    #  8. Delete backup branches
+    #  9. Checkout the branch the user was originally on (if user wasn't on a merged pr branch)
+    # 10. Re-apply local stash if necessary
+    merged_pulls = []
+    try:
+        logger.phase('rebase and merge')
+        orig_branch, checkout_original_branch = _stash_local_changes(git_repo, undo_stack)
+
+        # Checkout the base branch and bring it up to date, all pull requests get merged on top of it
+        log.info(f'Checking out {base_ref}')
+        _checkout_branch(git_repo, fetcher, base_ref)
+        log.info(f'Updating {base_ref}')
+        git_repo.git.rebase(fetcher.tracking_ref(base_ref))
+
+        undo_queue_merges_action = _undo_merges_action(git_repo, fetcher, base_ref)
+        undo_stack.append(undo_queue_merges_action)
+
+        for pull in pulls:
+            log.info(f'{colorama.Fore.CYAN}Queueing Pull Request #{pull.number}: {pull.title}')
+
+            # Has the pr branch diverged from remote?
+            if not _is_branch_in_rebaseable_state(git_repo, fetcher, pull.head.ref):
+                skip_pull(pull.number, f'The local branch `{pull.head.ref}` has diverged from remote')
+                continue
+
+            # Undo actions for this pull request only, so a failure backs out of this pull request and nothing else
+            pull_undo_stack = []
+            base_sha_before_merge = git_repo.head.commit.hexsha
+            def undo_pull_merge(base_sha_before_merge=base_sha_before_merge):
+                try:
+                    git_repo.git.merge('--abort')
+                except Exception:
                     pass
-                git_repo.remotes.origin.fetch()
+                git_repo.git.reset('--hard')
+                git_repo.git.checkout(base_ref)
+                git_repo.git.reset('--hard', base_sha_before_merge)
+            pull_undo_stack.append(UndoAction(undo_pull_merge, failure_is_fatal=True))
 
+            try:
+                undo_rebase_action = _check_out_pull_branch(git_repo, fetcher, pull, pull_undo_stack)
+
+                # Rebase the pr branch on top of the local base, which already contains the previous merges
+                log.info(f'{colorama.Fore.CYAN}Rebasing {pull.head.ref} onto {base_ref}')
+                git_repo.git.rebase(base_ref)
+
+                # Merge pr branch into the local base
+                log.info(f'Checking out {base_ref}')
+                git_repo.git.checkout(base_ref)
+
+                commit_stats = stats.branch_stats(git_repo, base_ref, pull.head.ref)
+                pull_with_squash = merge_with_squash or (commit_stats.num_commits == 1 and merge_config.always_squash_single_commit_pulls)
+
+                commit_msg_format = merge_config.squash_msg_format if pull_with_squash else merge_config.merge_msg_format
+                merge_msg = _format_squash_msg(commit_msg_format, pull, commit_stats) if pull_with_squash else _format_merge_msg(commit_msg_format, pull)
+                if pull_with_squash:
+                    # Do the squash, and point the pr branch at the squashed commit. Once the base is pushed,
+                    # the pr head is part of it and GitHub marks the pull request as merged instead of closed.
+                    log.info(f'{colorama.Fore.CYAN}Squashing {pull.head.ref} onto {base_ref}')
+                    git_repo.git.merge('--squash', pull.head.ref)
+                    git_repo.git.commit(*_author_args(commit_stats.main_author), '-m', merge_msg)
+                    git_repo.git.branch('-f', pull.head.ref, 'HEAD')
+                else:
+                    # Regular merge preserving all commits from the original branch
+                    log.info(f'{colorama.Fore.CYAN}Merging {pull.head.ref} onto {base_ref}')
+                    git_repo.git.merge(pull.head.ref, '--no-ff', '-m', merge_msg)
+
+            except git.CommandError as command_error:
+                _log_git_command_error(command_error)
+                _revert_back_to_original_state(pull_undo_stack)
+                skip_pull(pull.number, f'Could not rebase or merge `{pull.head.ref}` onto `{base_ref}`')
+                continue
+
+            # The pull request merged locally, its remaining undo actions are now part of the queue
+            pull_undo_stack.remove(pull_undo_stack[0])
+            undo_stack.extend(pull_undo_stack)
+            merged_pulls.append((pull, pull_with_squash, undo_rebase_action))
+
+        if not any(merged_pulls):
+            log.error('None of the pull requests could be merged')
+            return
+
+        logger.phase('preview')
+        # Output one combined preview of the local base branch with new commits highlighted
+        num_regular_merges = len([_ for _, pull_with_squash, _ in merged_pulls if not pull_with_squash])
+        _log_merge_preview(git_repo, base_ref, fetcher.tracking_ref(base_ref), 2 * num_regular_merges)
+        if any(skipped_pulls):
+            log.warning('Skipped: ' + ', '.join(f'#{number}' for number, _ in skipped_pulls))
+
+        logger.phase('confirm')
+        # Ask for permission to push
+        confirm_merge_answer = input(f"Does this look correct? (y/n) ") or "n"
+
+        # Push the merges
+        if confirm_merge_answer.lower() == 'y':
+            # Push all rebased pr branches and the base together
+            head_updates = [(pull.head.ref, fetcher.tracking_ref(pull.head.ref), f'refs/heads/{pull.head.ref}') for pull, _, _ in merged_pulls]
+            if _publish_merge(git_repo, github_repo, fetcher, undo_stack, base_ref, [pull for pull, _, _ in merged_pulls],
+                    head_updates + [(base_ref, fetcher.tracking_ref(base_ref), f'refs/heads/{base_ref}')]):
                 # Pop some elements
-                undo_stack.remove(undo_rebase_action)
-                undo_stack.remove(undo_pr_merge_action)
+                undo_stack.remove(undo_queue_merges_action)
+                for _, _, undo_rebase_action in merged_pulls:
+                    undo_stack.remove(undo_rebase_action)
 
-                # If user was on the pr branch before running the script, stay on the base branch which we are currently on
-                if orig_branch.name == pull.head.ref:
+                # If user was on a merged pr branch before running the script, stay on the base branch which we are currently on
+                merged_head_refs = [pull.head.ref for pull, _, _ in merged_pulls]
+                if orig_branch.name in merged_head_refs:
                     # No longer need to go back to original branch
                     undo_stack.remove(checkout_original_branch)
 
-                # Delete local pr branch
-                git_repo.git.branch('-D', pull.head.ref)
-
+                # Delete local pr branches
+                git_repo.git.branch('-D', *merged_head_refs)
 
     except git.CommandError as command_error:
-        command = command_error._cmdline
-        output = command_error.stdout[12:-1] if len(command_error.stdout) > 0 else ''
-        output = output.replace('\n', '\n> ')
-        log.error(f'An unexpected git error occurred:\n> {command}\n> {output}')
+        _log_git_command_error(command_error)
 
     except Exception as ex:
         log.error(f'An unexpected error occurred: {ex}')
 
     finally:
+        logger.phase('revert')
         # Done! Apply all necessary actions to go back to the starting state
-        revert_back_to_original_state()
+        _revert_back_to_original_state(undo_stack)
 
+        _log_skipped_pulls(skipped_pulls)
 
-def run():
-    # Command line arg parsing
+
+def _find_stack(github_repo, top_pull):
+    # Walks down the base branches from the top pull request, as long as they are the head of another open pull
+    # request. Returns the stack bottom-up.
+    owner = github_repo.full_name.split('/')[0]
+    stack = [top_pull]
+    while True:
+        base_pulls = list(github_repo.get_pulls(state='open', head=f'{owner}:{stack[-1].base.ref}'))
+        if not any(base_pulls):
+            break
+        if len(base_pulls) > 1:
+            log.error(f'More than one open pull request has the head branch `{stack[-1].base.ref}`: ' + ', '.join(f'#{pull.number}' for pull in base_pulls))
+            exit(1)
+        if base_pulls[0].number in [pull.number for pull in stack]:
+            log.error(f'The pull requests stacked under #{top_pull.number} are based on each other in a loop')
+            exit(1)
+        stack.append(base_pulls[0])
+    return list(reversed(stack))
+
+
+def merge_stack_command(merge_with_squash, git_repo, github_repo, top_pull_number, merge_config):
+    log.info(f'{colorama.Fore.CYAN}Preparing to merge the stack of Pull Request #{top_pull_number}')
+
+    logger.phase('validate')
+    # Pull requests that could not be merged are skipped, along with the ones stacked on them
+    skipped_pulls = []
+    def skip_pull(pull_number, reason):
+        log.error(f'Skipping Pull Request #{pull_number}: {reason}')
+        skipped_pulls.append((pull_number, reason))
+
+    top_pull, reason = _find_open_pull(github_repo, top_pull_number)
+    if top_pull is None:
+        log.error(reason)
+        exit(1)
+
+    log.info('Finding the pull requests it is stacked on')
+    pulls = _find_stack(github_repo, top_pull)
+    base_ref = pulls[0].base.ref
+    log.info(f'Stack onto {base_ref}: ' + ' <- '.join(f'#{pull.number} ({pull.head.ref})' for pull in pulls))
+
+    def check_mergeability(pulls):
+        for i, pull in enumerate(pulls):
+            _wait_for_mergeability(pull)
+            if not pull.mergeable or not pull.rebaseable:
+                skip_pull(pull.number, 'This pull request is not mergeable')
+                for stacked_pull in pulls[i + 1:]:
+                    skip_pull(stacked_pull.number, f'It is stacked on #{pull.number}, which is not mergeable')
+                pulls = pulls[:i]
+                break
+        if not any(pulls):
+            _log_skipped_pulls(skipped_pulls)
+        return pulls
+    fetcher, pulls = _fetch_for_merge(git_repo, base_ref, pulls, check_mergeability)
+
+    # Stacks are always rebased in memory, each commit is rebased once however many pull requests are stacked on it
+    try:
+        _merge_queue_without_checkout(merge_with_squash, git_repo, github_repo, pulls, merge_config, fetcher, skip_pull, skipped_pulls, stacked=True)
+    finally:
+        _log_skipped_pulls(skipped_pulls)
+
+
+def serve_command(git_repo, github_repo, merge_config, serve_config, host, port):
+    from . import webhook
+
+    # Merges run unattended, so they're made in memory and leave the working tree and local branches alone
+    merge_config.no_checkout = True
+
+    def merge_if_ready(pull_number):
+        # The webhooks say the pull request may be ready, Github confirms it with one request before we merge
+        try:
+            readiness = graphql.pull_readiness(github_repo, pull_number)
+        except Exception as ex:
+            log.error(f'Could not check whether Pull Request #{pull_number} is ready to merge: {ex}')
+            return
+        if readiness['state'] != 'OPEN' or readiness['is_draft'] or serve_config.ready_label not in readiness['labels']:
+            log.debug(f'Pull Request #{pull_number} is not ready to merge')
+            return
+        if readiness['ci_status'] not in [None, 'SUCCESS']:
+            log.info(f'Pull Request #{pull_number} is waiting for its checks ({readiness["ci_status"].lower()})')
+            return
+        try:
+            merge_command(serve_config.squash, git_repo, github_repo, pull_number, merge_config, unattended=True)
+        except SystemExit:
+            log.error(f'Could not merge Pull Request #{pull_number}')
+
+    tracker = webhook.ReadinessTracker(serve_config.ready_label,
+        lambda pull_number: github_repo.get_pull(pull_number).raw_data,
+        lambda sha: [pull.raw_data for pull in github_repo.get_commit(sha).get_pulls()])
+    scheduler = webhook.MergeScheduler(merge_if_ready)
+    log.info(f'Merging pull requests labeled `{serve_config.ready_label}` once their checks pass')
+    webhook.serve(host, port, serve_config.webhook_secret, github_repo.full_name, tracker, scheduler)
+
+
+def _parse_args(argv=None):
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
         description="Merges github pull requests by rebasing before merging to maintain linear history"
     )
     parser.add_argument('-t', '--token', help='Github access token to use')
     parser.add_argument('-v', '--verbose', action='store_true', help="Verbose output")
+    parser.add_argument('--no-cache', action='store_true', help="Don't use the on-disk GitHub API response cache")
+    parser.add_argument('--no-daemon', action='store_true', help="Run in this process even if a daemon is running for this repository")
+    parser.add_argument('--profile', action='store_true', help="Print a summary of where time is spent and write a Chrome trace-event file")
+    parser.add_argument('--profile-output', default=PROFILE_FILE_NAME, metavar='FILE', help=f"Trace file written by --profile (default: {PROFILE_FILE_NAME})")
     subparsers = parser.add_subparsers(title='Commands', dest='cmd')
     subparsers.required = True
     list_command_parser = subparsers.add_parser('list', aliases=['ls'])
-    list_command_parser.add_argument('-m', '--mine', action='store_true', help='List only pull requests opened by me')
+    list_author_group = list_command_parser.add_mutually_exclusive_group()
+    list_author_group.add_argument('-m', '--mine', action='store_true', help='List only pull requests opened by me')
+    list_author_group.add_argument('--author', metavar='LOGIN', help='List only pull requests opened by this user')
+    list_command_parser.add_argument('--base', metavar='BRANCH', help='List only pull requests that target this branch')
+    list_command_parser.add_argument('--head', metavar='BRANCH', help='List only pull requests of this branch')
+    list_command_parser.add_argument('--stale', type=int, metavar='DAYS', help='List only pull requests not updated in this many days')
+    list_command_parser.add_argument('--format', choices=output.FORMATS, default='table', help='Output format, rows are written as they arrive except for table')
+    list_command_parser.add_argument('--limit', type=int, metavar='N', help='List at most N pull requests, newest first')
     merge_command_parser = subparsers.add_parser('merge')
-    merge_command_parser.add_argument('number', type=int, nargs=1, help='pull request number')
+    merge_command_parser.add_argument('number', type=int, nargs='+', help='pull request number(s), multiple numbers are merged as a queue')
+    merge_command_parser.add_argument('--no-checkout', action='store_true', help='Rebase and merge without touching the index or working tree')
+    merge_command_parser.add_argument('--stack', action='store_true', help='Merge the pull request and all the pull requests it is stacked on, bottom-up')
     squash_command_parser = subparsers.add_parser('squash')
-    squash_command_parser.add_argument('number', type=int, nargs=1, help='pull request number')
-    args = vars(parser.parse_args())
+    squash_command_parser.add_argument('number', type=int, nargs='+', help='pull request number(s), multiple numbers are squashed as a queue')
+    squash_command_parser.add_argument('--no-checkout', action='store_true', help='Rebase and squash without touching the index or working tree')
+    squash_command_parser.add_argument('--stack', action='store_true', help='Squash the pull request and all the pull requests it is stacked on, bottom-up')
+    check_command_parser = subparsers.add_parser('check', help='Check whether pull requests rebase cleanly onto their base, without changing anything')
+    check_command_parser.add_argument('number', type=int, nargs='*', help='pull request number(s) to check')
+    check_command_parser.add_argument('-a', '--all', action='store_true', help='Check all open pull requests')
+    serve_command_parser = subparsers.add_parser('serve', help='Receive Github webhooks and merge pull requests once they are ready')
+    serve_command_parser.add_argument('--host', help='Address to listen on (default: 127.0.0.1)')
+    serve_command_parser.add_argument('--port', type=int, help='Port to listen on (default: 8080)')
+    daemon_command_parser = subparsers.add_parser('daemon', help='Keep the Github client and repository warm between commands')
+    daemon_command_parser.add_argument('action', choices=['start', 'stop', 'status'])
+    daemon_command_parser.add_argument('--idle-timeout', type=int, metavar='MINUTES', help='Stop the daemon after this many minutes without commands')
+    daemon_command_parser.add_argument('--foreground', action='store_true', help="Don't detach from the terminal")
+    return vars(parser.parse_args(argv))
 
-    # Logging setup
-    colorama.init(autoreset=True)
-    logger.setup_logging(logging.DEBUG if args['verbose'] else logging.INFO)
 
-    # Repo setup
-    git_repo = None
-    try:
-        git_repo = git.Repo(search_parent_directories=True)
-    except git.InvalidGitRepositoryError:
-        log.error('This directory is not a valid git repository')
-        exit(1)
-    git_remote_urls = [url for urls in [list(r.urls) for r in git_repo.remotes] for url in urls]
-    github_remote_urls = [url for url in git_remote_urls if 'github.com' in url]
-    if not any(github_remote_urls):
-        log.error('This is not a Github repository')
-        exit(1)
+class ClientState:
+    """What commands need that is expensive to set up: the repository, the configs and the Github client.
+
+    Set up once per run, or once for all the commands a daemon runs.
+    """
+
+    def __init__(self):
+        self.git_repo = None
+        self.github_repo_name = None
+        self.config = None
+        self.config_file_mtimes = None
+        # Github repos by access token, their token has been validated
+        self.github_repos = {}
+
+    def open_repo(self):
+        import git
+
+        if self.git_repo is not None:
+            return
+        try:
+            self.git_repo = git.Repo(search_parent_directories=True)
+        except git.InvalidGitRepositoryError:
+            log.error('This directory is not a valid git repository')
+            exit(1)
+        git_remote_urls = [url for urls in [list(r.urls) for r in self.git_repo.remotes] for url in urls]
+        github_remote_urls = [url for url in git_remote_urls if 'github.com' in url]
+        if not any(github_remote_urls):
+            log.error('This is not a Github repository')
+            exit(1)
+
+        # Parse github repo name from remote url:
+        # https://github.com/spatialsys/Spatial-2.0.git
+        # git@github.com:spatialsys/Spatial-2.0.git
+        self.github_repo_name = re.search(r'.*[:/](.*/.*)\.git', github_remote_urls[0]).group(1)
+
+    def load_config(self):
+        # Configs are only read again when they changed
+        git_repo_dir = self.git_repo.working_tree_dir
+        global_config_file_path = os.path.expanduser(f'~/{cfg.RC_FILE_NAME}')
+        local_config_file_path = os.path.join(git_repo_dir, cfg.RC_FILE_NAME)
+        config_files = [global_config_file_path]
+        if os.path.exists(local_config_file_path):
+            log.debug(f'Reading from local repo config: {local_config_file_path}')
+            config_files.insert(0, local_config_file_path)
+        config_file_mtimes = [(path, os.path.getmtime(path) if os.path.exists(path) else None) for path in config_files]
+        if config_file_mtimes != self.config_file_mtimes:
+            self.config = configparser.ConfigParser()
+            self.config.read(config_files)
+            self.config_file_mtimes = config_file_mtimes
+        return self.config
+
+    def connect(self, token, no_cache):
+        from github import Github, BadCredentialsException
+        from . import cache
+
+        # The connection classes are installed even without a response cache, they make api calls safe to run concurrently
+        cache_config = cfg.CacheConfig(self.config)
+        response_cache = None
+        if cache_config.enabled and not no_cache:
+            response_cache = cache.ResponseCache(cache.default_cache_dir(), cache_config.max_size_mb * 1024 * 1024)
+        cache.install(response_cache)
+
+        # Auth checkup
+        logger.phase('auth')
+        github_access_token = token
+        if not github_access_token:
+            github_access_token = self.config.get('auth', 'github_access_token', fallback=None)
+        if github_access_token in self.github_repos:
+            return self.github_repos[github_access_token]
+        github_access_token = auth.initial_auth_flow_if_necessary(github_access_token)
 
-    # Load configs
-    git_repo_dir = git_repo.git.rev_parse('--show-toplevel')
-    global_config_file_path = os.path.expanduser(f'~/{cfg.RC_FILE_NAME}')
-    local_config_file_path = os.path.join(git_repo_dir, cfg.RC_FILE_NAME)
-    config_files = [global_config_file_path]
-    if os.path.exists(local_config_file_path):
-        log.debug(f'Reading from local repo config: {local_config_file_path}')
-        config_files.insert(0, local_config_file_path)
-    config = configparser.ConfigParser()
-    config.read(config_files)
-
-    # Auth checkup
-    github_access_token = args['token']
-    if not github_access_token:
-        github_access_token = config.get('auth', 'github_access_token', fallback=None)
-    github_access_token = auth.initial_auth_flow_if_necessary(github_access_token)
-
-    # Parse github repo name from remote url:
-    # https://github.com/spatialsys/Spatial-2.0.git
-    # git@github.com:spatialsys/Spatial-2.0.git
-    github_repo_name = re.search(r'.*[:/](.*/.*)\.git', github_remote_urls[0]).group(1)
-
-    # Github setup
-    github = Github(github_access_token)
-    github_repo = github.get_repo(github_repo_name)
+        # Github setup
+        logger.phase('github setup')
+        github = Github(github_access_token, per_page=API_PAGE_SIZE)
+        try:
+            github_repo = github.get_repo(self.github_repo_name)
+        except BadCredentialsException:
+            # The token was revoked or expired since it was last validated, so validate it again
+            auth.invalidate_token_validation()
+            log.error('Github authentication failed')
+            github_access_token = auth.initial_auth_flow_if_necessary(github_access_token)
+            github = Github(github_access_token, per_page=API_PAGE_SIZE)
+            github_repo = github.get_repo(self.github_repo_name)
+        self.github_repos[github_access_token] = (github, github_repo)
+        return github, github_repo
+
+
+def _run_command(args, state):
+    logger.phase('setup')
+    state.open_repo()
+    config = state.load_config()
+    github, github_repo = state.connect(args['token'], args['no_cache'])
 
     # Run the command
+    logger.end_phase()
     if args['cmd'] in ['list', 'ls']:
-        list_command(github, github_repo, args['mine'])
+        if args['limit'] is not None and args['limit'] < 1:
+            log.error('--limit must be at least 1')
+            exit(1)
+        with logger.span('list'):
+            if any(args[name] is not None for name in ['author', 'base', 'head', 'stale']):
+                filtered_list_command(github, github_repo, cfg.IndexConfig(config), args['mine'], args['base'],
+                    args['head'], args['author'], args['stale'], args['format'], args['limit'])
+            else:
+                list_command(github, github_repo, args['mine'], args['format'], args['limit'])
+    elif args['cmd'] == 'check':
+        if args['all'] == any(args['number']):
+            log.error('Give either pull request numbers or --all')
+            exit(1)
+        if not plumbing.is_supported(state.git_repo):
+            log.error(f'Checking pull requests requires git {".".join(map(str, plumbing.MIN_GIT_VERSION))} or newer')
+            exit(1)
+        with logger.span('check'):
+            check_command(github, state.git_repo, github_repo, args['number'])
     elif args['cmd'] in ['merge', 'squash']:
         merge_config = cfg.MergeConfig(config)
 
@@ -394,7 +1343,120 @@ def run():
             log.error('Squash merge is not enabled in local configuration (squash_cmd_enabled = False)')
             exit(1)
 
-        merge_command(merge_with_squash, git_repo, github_repo, args['number'][0], merge_config)
+        if args['no_checkout']:
+            merge_config.no_checkout = True
+        if merge_config.no_checkout and not plumbing.is_supported(state.git_repo):
+            log.error(f'Merging without checkout requires git {".".join(map(str, plumbing.MIN_GIT_VERSION))} or newer')
+            exit(1)
+
+        if args['stack']:
+            if len(args['number']) > 1:
+                log.error('Only give the number of the top pull request of the stack')
+                exit(1)
+            if not plumbing.is_supported(state.git_repo):
+                log.error(f'Merging a stack requires git {".".join(map(str, plumbing.MIN_GIT_VERSION))} or newer')
+                exit(1)
+
+        with logger.span(args['cmd']):
+            if args['stack']:
+                merge_stack_command(merge_with_squash, state.git_repo, github_repo, args['number'][0], merge_config)
+            elif len(args['number']) > 1:
+                merge_queue_command(merge_with_squash, state.git_repo, github_repo, args['number'], merge_config)
+            else:
+                merge_command(merge_with_squash, state.git_repo, github_repo, args['number'][0], merge_config)
+    elif args['cmd'] == 'serve':
+        merge_config = cfg.MergeConfig(config)
+        serve_config = cfg.ServeConfig(config)
+        if not serve_config.webhook_secret:
+            log.error('Set webhook_secret in the [serve] section of .linmergerc, to the secret of the Github webhook')
+            exit(1)
+        if serve_config.squash and not merge_config.squash_cmd_enabled:
+            log.error('Squash merge is not enabled in local configuration (squash_cmd_enabled = False)')
+            exit(1)
+        if not plumbing.is_supported(state.git_repo):
+            log.error(f'Serving requires git {".".join(map(str, plumbing.MIN_GIT_VERSION))} or newer')
+            exit(1)
+        serve_command(state.git_repo, github_repo, merge_config, serve_config, args['host'] or serve_config.host,
+            args['port'] or serve_config.port)
+
+
+def daemon_command(args):
+    if not daemon.is_supported():
+        log.error('The daemon is not supported on this platform')
+        exit(1)
+
+    state = ClientState()
+    state.open_repo()
+    socket_path = daemon.socket_path(state.git_repo.working_tree_dir)
+
+    if args['action'] == 'status':
+        status = daemon.send_control(socket_path, 'status')
+        if status is None:
+            log.info('No daemon is running for this repository')
+        else:
+            log.info(f'Daemon running (pid {status["pid"]}), up for {status["uptime_seconds"] // 60} minutes, '
+                f'ran {status["commands"]} commands')
+    elif args['action'] == 'stop':
+        if daemon.send_control(socket_path, 'stop') is None:
+            log.info('No daemon is running for this repository')
+        else:
+            log.info('Daemon stopped')
+    elif not args['foreground']:
+        # Authenticate while we can still prompt, the daemon runs detached from the terminal
+        state.load_config()
+        state.connect(args['token'], args['no_cache'])
+        daemon_argv = ['daemon', 'start', '--foreground']
+        if args['idle_timeout'] is not None:
+            daemon_argv += ['--idle-timeout', str(args['idle_timeout'])]
+        if daemon.spawn(socket_path, daemon_argv):
+            log.info(f'Daemon started, `git pr` commands in this repository now run in it')
+        else:
+            log.error('The daemon did not start, run `git pr daemon start --foreground` to see why')
+            exit(1)
+    else:
+        config = state.load_config()
+        idle_timeout_minutes = args['idle_timeout'] or cfg.DaemonConfig(config).idle_timeout_minutes
+
+        def handle_command(argv):
+            command_args = _parse_args(argv)
+            logger.setup_logging(logging.DEBUG if command_args['verbose'] else logging.INFO)
+            try:
+                _run_command(command_args, state)
+            except BaseException:
+                # Start from scratch after a failure, the token may have been revoked
+                state.github_repos.clear()
+                raise
+
+        daemon.serve(socket_path, idle_timeout_minutes * 60, handle_command)
+
+
+def run():
+    # Command line arg parsing
+    args = _parse_args()
+
+    # Logging setup
+    colorama.init(autoreset=True)
+    logger.setup_logging(logging.DEBUG if args['verbose'] else logging.INFO)
+
+    if args['cmd'] == 'daemon':
+        daemon_command(args)
+        return
+
+    # Hand the command to this repository's daemon if one is running. Profiling and serving always run in-process.
+    if not args['no_daemon'] and not args['profile'] and args['cmd'] != 'serve':
+        exit_code = daemon.forward(sys.argv[1:])
+        if exit_code is not None:
+            exit(exit_code)
+
+    # Profiling, the trace is written on exit so that failed runs can be profiled too
+    if args['profile']:
+        logger.enable_tracing(f'git pr {args["cmd"]}')
+        atexit.register(logger.write_profile, args['profile_output'])
+        logger.phase('import')
+        import git
+        logger.trace_git_commands(git.Repo)
+
+    _run_command(args, ClientState())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,42 @@
+import sys
+import json
+
+FORMATS = ['table', 'json', 'ndjson', 'tsv']
+
+
+class RowWriter:
+    """Writes rows in a machine-readable format as they come, so scripts see the first rows before the last page arrives"""
+
+    def __init__(self, output_format, columns, stream=None):
+        self.output_format = output_format
+        self.columns = columns
+        self.stream = stream or sys.stdout
+        self.num_rows = 0
+        if output_format == 'json':
+            self.stream.write('[')
+        elif output_format == 'tsv':
+            self.stream.write('\t'.join(columns) + '\n')
+
+    def write(self, rows):
+        for row in rows:
+            values = {column: row.get(column) for column in self.columns}
+            if self.output_format == 'json':
+                self.stream.write((',\n' if self.num_rows > 0 else '\n') + json.dumps(values))
+            elif self.output_format == 'ndjson':
+                self.stream.write(json.dumps(values) + '\n')
+            else:
+                self.stream.write('\t'.join(_tsv_value(value) for value in values.values()) + '\n')
+            self.num_rows += 1
+        self.stream.flush()
+
+    def close(self):
+        if self.output_format == 'json':
+            self.stream.write('\n]\n' if self.num_rows > 0 else ']\n')
+        self.stream.flush()
+
+
+def _tsv_value(value):
+    # Tabs and newlines would split the row, titles can have them
+    if value is None:
+        return ''
+    return ' '.join(str(value).replace('\t', ' ').splitlines())
@@ -0,0 +1,77 @@
+from . import logger
+
+log = logger.logger
+
+# `git merge-tree --write-tree` is needed to merge without a worktree
+MIN_GIT_VERSION = (2, 38)
+
+
+class MergeConflictError(Exception):
+    def __init__(self, commit, conflicted_files):
+        self.commit = commit
+        self.conflicted_files = conflicted_files
+        super().__init__(f'Merge conflict while applying {commit[:10]} in: {", ".join(conflicted_files)}')
+
+
+def is_supported(git_repo):
+    return git_repo.git.version_info[:2] >= MIN_GIT_VERSION
+
+
+def merge_tree(git_repo, ours, theirs):
+    # Merges two commits in memory, returns the resulting tree or raises if there are conflicts
+    status, stdout, _ = git_repo.git.merge_tree('--write-tree', '--name-only', ours, theirs,
+        with_extended_output=True, with_exceptions=False)
+    lines = stdout.split('\n')
+    if status == 1:
+        conflicted_files = []
+        for line in lines[1:]:
+            if not line:
+                break
+            conflicted_files.append(line)
+        raise MergeConflictError(theirs, conflicted_files)
+    elif status != 0:
+        raise RuntimeError(f'git merge-tree failed on {ours} and {theirs}: {stdout}')
+    return lines[0]
+
+
+def commit_tree(git_repo, tree, parents, message, author=None):
+    # author is (name, email, date) or None to use the current user
+    env = None
+    if author is not None:
+        name, email, date = author
+        env = {'GIT_AUTHOR_NAME': name, 'GIT_AUTHOR_EMAIL': email}
+        if date:
+            env['GIT_AUTHOR_DATE'] = date
+    parent_args = [arg for parent in parents for arg in ('-p', parent)]
+    return git_repo.git.commit_tree(tree, *parent_args, '-m', message, env=env)
+
+
+def rebase(git_repo, onto, head, upstream=None):
+    # Rebases the commits of head that aren't in onto on top of onto, without touching the index or worktree.
+    # Picks the same commits as `git rebase`: merges and commits already applied upstream are skipped.
+    # Like `git rebase --onto`, commits in upstream are left out too, e.g. those of the branch head is stacked on.
+    # Returns the new head commit, or raises MergeConflictError.
+    exclude_upstream = [f'^{upstream}'] if upstream else []
+    commit_log = git_repo.git.log('-z', '--reverse', '--topo-order', '--no-merges', '--right-only', '--cherry-pick',
+        '--date=raw', '--format=%H%x1f%P%x1f%T%x1f%an%x1f%ae%x1f%ad%x1f%B', f'{onto}...{head}', *exclude_upstream)
+    new_head = git_repo.git.rev_parse(onto)
+    new_head_tree = git_repo.git.rev_parse(f'{new_head}^{{tree}}')
+    for record in commit_log.split('\0'):
+        if not record.strip():
+            continue
+        commit, parents, tree, author_name, author_email, author_date, message = record.strip('\n').split('\x1f', 6)
+        parent = parents.split(' ')[0]
+
+        # To cherry-pick in memory, merge with a temporary commit whose second parent is the original parent. That
+        # makes the original parent the merge base, just like `git cherry-pick` uses it.
+        merge_helper = commit_tree(git_repo, new_head_tree, [new_head, parent], 'merge-base helper')
+        picked_tree = merge_tree(git_repo, merge_helper, commit)
+
+        # Drop commits that became empty, like `git rebase` does, but keep commits that were empty to begin with
+        if picked_tree == new_head_tree and tree != git_repo.git.rev_parse(f'{parent}^{{tree}}'):
+            log.debug(f'Dropping {commit[:10]}, its changes are already applied')
+            continue
+
+        new_head = commit_tree(git_repo, picked_tree, [new_head], message.rstrip('\n'), (author_name, author_email, author_date))
+        new_head_tree = picked_tree
+    return new_head
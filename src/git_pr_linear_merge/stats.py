@@ -0,0 +1,47 @@
+from collections import Counter
+from . import logger
+
+log = logger.logger
+
+# Separates the commits in the `git log` output, it can't appear in author names or trailers
+COMMIT_SEPARATOR = '\x1e'
+# Names and emails go through .mailmap, so an author who changed either is still counted once
+LOG_FORMAT = '%x1e%aN <%aE>%n%(trailers:key=Co-authored-by,valueonly)'
+
+
+class BranchStats:
+    """Commit count and author histograms of a range of commits"""
+
+    def __init__(self):
+        self.num_commits = 0
+        self.authors = Counter()
+        self.co_authors = Counter()
+
+    @property
+    def main_author(self):
+        # The author with most commits, ties go to the first one alphabetically. Formatted as `Name <email>`.
+        if not any(self.authors):
+            return None
+        return max(sorted(self.authors), key=self.authors.get)
+
+    @property
+    def other_authors(self):
+        # Everyone else who authored or co-authored a commit, sorted
+        return sorted((set(self.authors) | set(self.co_authors)) - {self.main_author})
+
+
+def branch_stats(git_repo, base, head):
+    # Gathers stats on the commits of head that aren't in base, in a single pass over the `git log` output.
+    # The output is streamed, so memory use doesn't grow with the number of commits, only with the number of authors.
+    stats = BranchStats()
+    process = git_repo.git.log(f'--format={LOG_FORMAT}', f'{base}..{head}', as_process=True)
+    for line in process.stdout:
+        line = line.decode('utf-8', errors='replace').rstrip('\n')
+        if line.startswith(COMMIT_SEPARATOR):
+            stats.num_commits += 1
+            stats.authors[line[1:]] += 1
+        elif line.strip():
+            stats.co_authors[line.strip()] += 1
+    process.wait()
+    log.debug(f'{stats.num_commits} commits in {base}..{head} by {len(stats.authors)} authors')
+    return stats
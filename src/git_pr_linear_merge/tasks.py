@@ -0,0 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
+from . import logger
+
+MAX_WORKERS = 8
+log = logger.logger
+
+
+class BackgroundTasks:
+    """Runs independent network calls on a bounded thread pool, collecting failures to report together at the end"""
+
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = []
+        self.failures = []
+
+    def submit(self, description, fn, *args, **kwargs):
+        future = self.executor.submit(fn, *args, **kwargs)
+        self.pending.append((description, future))
+        return future
+
+    def wait(self):
+        # Waits for all submitted tasks, returns False if any of them failed
+        succeeded = True
+        while len(self.pending) > 0:
+            description, future = self.pending.pop(0)
+            try:
+                future.result()
+            except Exception as ex:
+                self.failures.append((description, ex))
+                succeeded = False
+        return succeeded
+
+    def report_failures(self):
+        if any(self.failures):
+            log.error('The following steps failed:\n' + '\n'.join(f'  {description}: {ex}' for description, ex in self.failures))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Never leave calls running behind our back, e.g. while the undo stack is being applied
+        self.wait()
+        self.executor.shutdown()
+        self.report_failures()
+        return False
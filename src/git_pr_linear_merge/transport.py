@@ -0,0 +1,183 @@
+import json
+import time
+import random
+import threading
+import contextlib
+from urllib.parse import urlparse
+import requests
+from . import logger
+
+log = logger.logger
+
+GITHUB_API_URL = 'https://api.github.com'
+# Connections kept alive per host, enough for every background task to have its own
+POOL_SIZE = 16
+# Requests are spread out evenly until the rate limit resets once fewer than this many are left, but never more than
+# this many seconds apart, so that a command slows down instead of seeming to hang
+RATE_LIMIT_PACING_THRESHOLD = 100
+RATE_LIMIT_MAX_PACING_DELAY = 1
+# Seconds to wait after hitting a secondary rate limit without Retry-After, and between mutations from then on
+SECONDARY_RATE_LIMIT_WAIT = 60
+SECONDARY_RATE_LIMIT_MUTATION_INTERVAL = 1
+# Retries with exponential backoff and full jitter, in seconds
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8
+# Only these are retried after an error or a response we can't be sure about, retrying them has no side effects.
+# So are GraphQL queries, which are POSTs too.
+IDEMPOTENT_VERBS = {'GET', 'HEAD', 'OPTIONS'}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def session():
+    # One pooled session for the whole process, so every api call reuses the same keep-alive connections
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def is_mutation(verb, url, data):
+    # GraphQL queries only read, unlike GraphQL mutations and other POST, PATCH, PUT and DELETE requests
+    if verb in IDEMPOTENT_VERBS:
+        return False
+    if verb == 'POST' and urlparse(url).path.endswith('/graphql') and data:
+        try:
+            query = json.loads(data).get('query', '')
+        except (ValueError, AttributeError):
+            return True
+        return query.lstrip().startswith('mutation')
+    return True
+
+
+def _rate_limit_resource(url):
+    # Github keeps separate rate limits for these
+    path = urlparse(url).path
+    if path.endswith('/graphql'):
+        return 'graphql'
+    if '/search/' in path:
+        return 'search'
+    return 'core'
+
+
+class RequestScheduler:
+    """Paces api calls to stay under Github's primary and secondary rate limits, based on the headers of earlier responses"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Mutations are sent one at a time, Github's secondary rate limits punish concurrent ones
+        self.mutation_lock = threading.Lock()
+        self.rate_limits = {}
+        self.next_request_at = {}
+        self.blocked_until = 0
+        self.mutation_interval = 0
+        self.last_mutation_at = 0
+
+    def wait_for_turn(self, url, mutation):
+        resource = _rate_limit_resource(url)
+        with self.lock:
+            now = time.monotonic()
+            request_at = max(now, self.blocked_until, self.next_request_at.get(resource, 0))
+            if mutation:
+                request_at = max(request_at, self.last_mutation_at + self.mutation_interval)
+
+            # Spread the requests that are left evenly until the rate limit resets, rather than running out halfway
+            # through a merge
+            remaining, reset_at = self.rate_limits.get(resource, (None, None))
+            if remaining is not None and remaining < RATE_LIMIT_PACING_THRESHOLD:
+                reset_in = max(0, reset_at - time.time())
+                if remaining <= 0:
+                    request_at = max(request_at, now + reset_in)
+                else:
+                    self.next_request_at[resource] = request_at + min(reset_in / remaining, RATE_LIMIT_MAX_PACING_DELAY)
+                self.rate_limits[resource] = (remaining - 1, reset_at)
+
+        delay = request_at - time.monotonic()
+        if delay > 1:
+            log.warning(f'Close to the Github api rate limit, waiting {delay:.0f}s')
+        if delay > 0:
+            time.sleep(delay)
+
+    def update(self, url, response, mutation):
+        headers = response.headers
+        with self.lock:
+            if mutation:
+                self.last_mutation_at = time.monotonic()
+            if 'X-RateLimit-Remaining' in headers and 'X-RateLimit-Reset' in headers:
+                resource = headers.get('X-RateLimit-Resource') or _rate_limit_resource(url)
+                self.rate_limits[resource] = (int(headers['X-RateLimit-Remaining']), int(headers['X-RateLimit-Reset']))
+
+            retry_after = rate_limit_retry_after(response)
+            if retry_after is not None:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+                if is_secondary_rate_limit(response):
+                    self.mutation_interval = SECONDARY_RATE_LIMIT_MUTATION_INTERVAL
+
+
+def is_secondary_rate_limit(response):
+    return response.status_code in (403, 429) and 'secondary rate limit' in response.text.lower()
+
+
+def rate_limit_retry_after(response):
+    # Seconds to wait if the request was rejected because of a rate limit, None if it wasn't
+    if response.status_code not in (403, 429):
+        return None
+    if response.headers.get('Retry-After', '').isdigit():
+        return int(response.headers['Retry-After'])
+    if response.headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in response.headers:
+        return max(0, int(response.headers['X-RateLimit-Reset']) - time.time())
+    if is_secondary_rate_limit(response):
+        return SECONDARY_RATE_LIMIT_WAIT
+    return None
+
+
+scheduler = RequestScheduler()
+
+
+def _retry_delay(attempt):
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def request(verb, url, **kwargs):
+    # Sends a request through the shared session, paced by the scheduler.
+    # Requests rejected by a rate limit were never processed, so they're sent again once the limit allows it, whatever
+    # the verb. Connection errors and server errors only retry requests that aren't mutations: a merge or an edit that
+    # failed halfway may have been applied, sending it again blindly could apply it twice.
+    mutation = is_mutation(verb, url, kwargs.get('data'))
+    attempt = 0
+    while True:
+        scheduler.wait_for_turn(url, mutation)
+        start = time.perf_counter()
+        try:
+            with scheduler.mutation_lock if mutation else contextlib.nullcontext():
+                response = session().request(verb, url, **kwargs)
+        except requests.exceptions.ConnectionError as ex:
+            if mutation or attempt >= MAX_RETRIES:
+                raise
+            log.debug(f'{verb} {url} failed, retrying: {ex}')
+            time.sleep(_retry_delay(attempt))
+            attempt += 1
+            continue
+
+        if logger.tracer is not None:
+            logger.tracer.record_http_request(verb, url, response.status_code, len(response.content),
+                response.headers.get('X-RateLimit-Remaining'), start, time.perf_counter())
+        scheduler.update(url, response, mutation)
+
+        if attempt < MAX_RETRIES:
+            if rate_limit_retry_after(response) is not None:
+                log.warning(f'Github api rate limit hit, retrying {verb} {urlparse(url).path}')
+                attempt += 1
+                continue
+            if response.status_code >= 500 and not mutation:
+                log.debug(f'{verb} {url} failed with {response.status_code}, retrying')
+                time.sleep(_retry_delay(attempt))
+                attempt += 1
+                continue
+        return response
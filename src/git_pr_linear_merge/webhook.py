@@ -0,0 +1,228 @@
+import hmac
+import json
+import queue
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import logger
+
+# Github never sends larger payloads
+MAX_PAYLOAD_SIZE = 25 * 1024 * 1024
+HANDLED_EVENTS = ['pull_request', 'check_suite', 'status']
+# Check suite conclusions that don't block a merge
+PASSING_CONCLUSIONS = ['success', 'neutral', 'skipped']
+log = logger.logger
+
+
+def is_valid_signature(secret, body, signature_header):
+    # Github signs every payload with the webhook secret, in the X-Hub-Signature-256 header
+    if not signature_header or not signature_header.startswith('sha256='):
+        return False
+    expected_signature = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected_signature, signature_header[len('sha256='):])
+
+
+class PullState:
+    """What the webhooks told us about an open pull request"""
+
+    def __init__(self, number):
+        self.number = number
+        self.base_ref = None
+        self.head_sha = None
+        self.labels = set()
+        self.is_draft = False
+        # Check suites of the head commit by id and statuses by context, True once they passed
+        self.checks = {}
+
+    def is_candidate(self, ready_label):
+        # Checks we haven't heard of may have passed before we started, Github has the final word on those
+        return ready_label in self.labels and not self.is_draft and all(self.checks.values())
+
+
+class ReadinessTracker:
+    """Readiness of pull requests, kept up to date from webhook events"""
+
+    def __init__(self, ready_label, get_pull, get_commit_pulls):
+        # Pull requests we haven't had an event of since starting are looked up with get_pull(number) and
+        # get_commit_pulls(sha), both return them as in the webhook payloads
+        self.ready_label = ready_label
+        self.get_pull = get_pull
+        self.get_commit_pulls = get_commit_pulls
+        self.pulls = {}
+        self.lock = threading.Lock()
+
+    def handle_event(self, event, payload):
+        # Returns the numbers of the pull requests that may have become ready to merge
+        if event == 'pull_request':
+            with self.lock:
+                pull_states = self._update_pull(payload['pull_request'])
+                return [state.number for state in pull_states if state.is_candidate(self.ready_label)]
+
+        if event == 'check_suite':
+            check_suite = payload['check_suite']
+            head_sha = check_suite['head_sha']
+            # An app can run several check suites on one commit, e.g. one per workflow, so they're told apart by id
+            check_name = f'check suite {check_suite["id"]}'
+            passed = payload['action'] == 'completed' and check_suite['conclusion'] in PASSING_CONCLUSIONS
+            # Check suites list the pull requests of their commit, except for pull requests from forks
+            listed_pulls = check_suite['pull_requests']
+        else:
+            head_sha = payload['sha']
+            check_name = f'status {payload["context"]}'
+            passed = payload['state'] == 'success'
+            listed_pulls = []
+
+        # Only passing checks can make a pull request ready, failures of pull requests we don't know can be skipped
+        looked_up_pulls = self._look_up_pulls(head_sha, listed_pulls) if passed else []
+        with self.lock:
+            for pull in looked_up_pulls:
+                self._update_pull(pull)
+            pull_states = self._update_checks(head_sha, check_name, passed)
+            return [state.number for state in pull_states if state.is_candidate(self.ready_label)]
+
+    def _look_up_pulls(self, head_sha, listed_pulls):
+        # After a restart we only know the pull requests that had an event since, the others are looked up on Github.
+        # So are those we know another head of, either the check is outdated or we missed their push, Github knows which.
+        # This happens outside the lock, other events don't wait for it.
+        with self.lock:
+            outdated_numbers = [pull['number'] for pull in listed_pulls
+                if pull['number'] not in self.pulls or self.pulls[pull['number']].head_sha != pull['head']['sha']]
+            is_known_commit = any(state.head_sha == head_sha for state in self.pulls.values())
+        try:
+            if any(outdated_numbers):
+                return [self.get_pull(pull_number) for pull_number in outdated_numbers]
+            if not any(listed_pulls) and not is_known_commit:
+                return self.get_commit_pulls(head_sha)
+        except Exception as ex:
+            log.warning(f'Could not look up the pull requests of commit {head_sha}: {ex}')
+        return []
+
+    def _update_pull(self, pull):
+        if pull['state'] != 'open':
+            self.pulls.pop(pull['number'], None)
+            return []
+        state = self.pulls.setdefault(pull['number'], PullState(pull['number']))
+        if state.head_sha != pull['head']['sha']:
+            # New commits, their checks start over
+            state.head_sha = pull['head']['sha']
+            state.checks = {}
+        state.base_ref = pull['base']['ref']
+        state.labels = {label['name'] for label in pull['labels']}
+        state.is_draft = pull.get('draft', False)
+        return [state]
+
+    def _update_checks(self, head_sha, check_name, passed):
+        # Checks belong to a commit, not to a pull request
+        pull_states = [state for state in self.pulls.values() if state.head_sha == head_sha]
+        for state in pull_states:
+            state.checks[check_name] = passed
+        return pull_states
+
+
+class MergeScheduler:
+    """Merges pull requests one at a time, merges share the repository's refs and fetches even for different bases"""
+
+    def __init__(self, merge_pull):
+        self.merge_pull = merge_pull
+        self.queue = queue.Queue()
+        self.queued_pull_numbers = set()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, pull_number):
+        with self.lock:
+            if pull_number in self.queued_pull_numbers:
+                return
+            self.queued_pull_numbers.add(pull_number)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._merge_queued_pulls, name='merge')
+                self.thread.start()
+            self.queue.put(pull_number)
+
+    def _merge_queued_pulls(self):
+        while True:
+            pull_number = self.queue.get()
+            if pull_number is None:
+                return
+            # Events that arrive while merging can queue the pull request again, merging checks it's still open
+            with self.lock:
+                self.queued_pull_numbers.discard(pull_number)
+            try:
+                self.merge_pull(pull_number)
+            except Exception as ex:
+                log.error(f'An unexpected error occurred while merging Pull Request #{pull_number}: {ex}')
+
+    def stop(self):
+        # Merges already queued finish first
+        with self.lock:
+            if self.thread is None:
+                return
+            self.queue.put(None)
+        self.thread.join()
+
+
+class WebhookServer(ThreadingHTTPServer):
+    def __init__(self, address, secret, repo_full_name, tracker, scheduler):
+        super().__init__(address, WebhookHandler)
+        self.secret = secret
+        self.repo_full_name = repo_full_name
+        self.tracker = tracker
+        self.scheduler = scheduler
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        log.debug(f'Webhook request: {format % args}')
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        # The length is checked before reading, a bad one would have us wait for a body that never comes or read forever
+        try:
+            content_length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            content_length = -1
+        if content_length < 0 or content_length > MAX_PAYLOAD_SIZE:
+            self._reply(400)
+            return
+        body = self.rfile.read(content_length)
+        if not is_valid_signature(self.server.secret, body, self.headers.get('X-Hub-Signature-256')):
+            log.warning(f'Ignoring a webhook with an invalid signature from {self.client_address[0]}')
+            self._reply(401)
+            return
+
+        event = self.headers.get('X-GitHub-Event')
+        if event not in HANDLED_EVENTS:
+            # Including the ping Github sends when the webhook is created
+            self._reply(200)
+            return
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self._reply(400)
+            return
+        if payload.get('repository', {}).get('full_name') != self.server.repo_full_name:
+            log.debug(f'Ignoring a {event} webhook of another repository')
+            self._reply(200)
+            return
+
+        log.debug(f'Received a {event} webhook')
+        for pull_number in self.server.tracker.handle_event(event, payload):
+            self.server.scheduler.submit(pull_number)
+        self._reply(202)
+
+
+def serve(host, port, secret, repo_full_name, tracker, scheduler):
+    # Runs until interrupted, then waits for the queued merges
+    server = WebhookServer((host, port), secret, repo_full_name, tracker, scheduler)
+    log.info(f'Listening for Github webhooks on http://{host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info('Stopping, waiting for the queued merges to finish')
+    finally:
+        server.server_close()
+        scheduler.stop()